@@ -0,0 +1,568 @@
+# Бенчмарки. Реальный мир сервера выложить нельзя, поэтому данные генерируются тут же.
+#   python bench.py encoding  - перекодировка decode.py на больших страницах
+#   python bench.py world DIR - сгенерировать синтетический мир 1.7.10 в DIR
+#   python bench.py scan      - сгенерировать мир и прогнать по нему book.py и decode.py,
+#                               результаты пишутся в bench_results/*.json
+#   python bench.py compare OLD.json NEW.json - сравнить два прогона scan
+
+import argparse, gzip, json, logging, math, multiprocessing, os, platform, random, struct, \
+    subprocess, sys, tempfile, time, uuid, zlib
+from contextlib import redirect_stdout
+from datetime import datetime
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:
+    # Windows - пиковую память не меряем
+    resource = None
+
+import book
+import decode
+from nbtstream import TAG_END, TAG_BYTE, TAG_SHORT, TAG_INT, TAG_LONG, TAG_FLOAT, TAG_DOUBLE, \
+    TAG_BYTE_ARRAY, TAG_STRING, TAG_LIST, TAG_COMPOUND, TAG_INT_ARRAY
+from region import SECTOR, GZIP, ZLIB
+from sinks import open_sink
+
+RESULTS_DIR = Path(__file__).with_name("bench_results")
+
+# Эталон: перекодировка из decode.py до ускорения, один в один.
+# Новая обязана давать тот же результат, bench это проверяет перед замером.
+
+def legacy_is_mixed_encoding(text):
+    cp1251_indicators = ['Ñ', 'Ð', 'Î', 'Â', 'à', 'á', 'â', 'ã', 'ä', 'å', 'æ', 'ç', 'è', 'é', 'ê', 'ë']
+    utf8_cyrillic = any('А' <= c <= 'я' for c in text)
+    cp1251_chars = any(indicator in text for indicator in cp1251_indicators)
+    return utf8_cyrillic and cp1251_chars
+
+def legacy_fix_mixed_encoding(text):
+    if not legacy_is_mixed_encoding(text):
+        return text
+    result = []
+    current_part = []
+    current_encoding = None
+    for char in text:
+        char_encoding = 'utf8' if ('А' <= char <= 'я' or char in 'Ёё') else 'cp1251'
+        if current_encoding is None:
+            current_encoding = char_encoding
+            current_part.append(char)
+        elif current_encoding == char_encoding:
+            current_part.append(char)
+        else:
+            part_text = ''.join(current_part)
+            if current_encoding == 'cp1251':
+                try:
+                    part_text = part_text.encode('latin1').decode('cp1251')
+                except:
+                    pass
+            result.append(part_text)
+            current_part = [char]
+            current_encoding = char_encoding
+    if current_part:
+        part_text = ''.join(current_part)
+        if current_encoding == 'cp1251':
+            try:
+                part_text = part_text.encode('latin1').decode('cp1251')
+            except:
+                pass
+        result.append(part_text)
+    return ''.join(result)
+
+def legacy_fix_encoding(text):
+    if legacy_is_mixed_encoding(text):
+        return legacy_fix_mixed_encoding(text)
+    try:
+        return text.encode('latin1').decode('cp1251')
+    except:
+        return text
+
+WORDS = ["привет", "мир", "книга", "сервер", "Ёлка", "ёж", "история", "шахта", "дом", "Игрок"]
+# Всякое, на чём старый код спотыкался: не-latin1 символы и байт 0x98, которого нет в cp1251
+ODD = ["—", "«", "»", "\x98", "§a", "\n", "...", "!", "123", "ABC"]
+
+def mojibake(word):
+    """Как слово выглядит после русификатора: cp1251-байты, прочитанные как latin1"""
+    return word.encode("cp1251").decode("latin1")
+
+def random_text(rnd, size, odd=0.2):
+    parts = []
+    n = 0
+    while n < size:
+        r = rnd.random()
+        if r < odd:
+            w = rnd.choice(ODD)
+        elif r < 0.5 + odd / 2:
+            w = rnd.choice(WORDS)
+        else:
+            w = mojibake(rnd.choice(WORDS))
+        parts.append(w)
+        n += len(w) + 1
+    return " ".join(parts)
+
+def check_encoding(texts):
+    """Новая перекодировка должна совпадать со старой байт в байт"""
+    for t in texts:
+        assert decode.is_mixed_encoding(t) == legacy_is_mixed_encoding(t), repr(t[:80])
+        assert decode.fix_mixed_encoding(t) == legacy_fix_mixed_encoding(t), repr(t[:80])
+        assert decode.fix_encoding(t) == legacy_fix_encoding(t), repr(t[:80])
+
+def timed(func, texts):
+    start = time.perf_counter()
+    for t in texts:
+        func(t)
+    return time.perf_counter() - start
+
+def bench_encoding(args):
+    rnd = random.Random(args.seed)
+    # Короткие строки со всеми краевыми случаями + большие страницы модовых книг
+    check_encoding([random_text(rnd, rnd.randint(0, 40)) for _ in range(5000)] +
+                   ["", "Ñ", "Ж", "ÑЖ", "\x98ÑЖ", "—Ð¿Ñ€Ð¸Ð²ÐµÑ‚ мир"])
+    for title, odd in (("Обычные страницы", 0.0), ("Страницы с символами вне cp1251", 0.2)):
+        pages = [random_text(rnd, args.page_size, odd) for _ in range(args.pages)]
+        check_encoding(pages[:10])
+        chars = sum(len(p) for p in pages)
+        old = timed(legacy_fix_encoding, pages)
+        new = timed(decode.fix_encoding, pages)
+        print(f"{title}: {len(pages)} по ~{args.page_size} символов")
+        print(f"  было:  {chars / old / 1e6:8.2f} млн символов/с")
+        print(f"  стало: {chars / new / 1e6:8.2f} млн символов/с  (x{old / new:.1f})")
+    # Повторяющиеся короткие строки (авторы, названия) - тут работает кеш
+    names = [random_text(rnd, 12) for _ in range(200)] * 50
+    old_names = timed(legacy_fix_encoding, names)
+    new_names = timed(decode.fix_encoding, names)
+    print(f"Короткие повторяющиеся строки: {len(names)}")
+    print(f"  было:  {len(names) / old_names:10.0f} строк/с")
+    print(f"  стало: {len(names) / new_names:10.0f} строк/с  (x{old_names / new_names:.1f})")
+
+# Синтетический мир. Писатель NBT минимальный: тег - пара (тип, байты значения),
+# compound и list собираются из таких пар
+
+def nbt_byte(v):
+    return TAG_BYTE, struct.pack(">b", v)
+
+def nbt_short(v):
+    return TAG_SHORT, struct.pack(">h", v)
+
+def nbt_int(v):
+    return TAG_INT, struct.pack(">i", v)
+
+def nbt_long(v):
+    return TAG_LONG, struct.pack(">q", v)
+
+def nbt_float(v):
+    return TAG_FLOAT, struct.pack(">f", v)
+
+def nbt_double(v):
+    return TAG_DOUBLE, struct.pack(">d", v)
+
+def nbt_string(s):
+    b = s.encode("utf-8")
+    return TAG_STRING, struct.pack(">H", len(b)) + b
+
+def nbt_byte_array(b):
+    return TAG_BYTE_ARRAY, struct.pack(">i", len(b)) + b
+
+def nbt_int_array(values):
+    return TAG_INT_ARRAY, struct.pack(">i%di" % len(values), len(values), *values)
+
+def nbt_list(tags):
+    # Пустой список, как и в игре, с типом TAG_End
+    item_type = tags[0][0] if tags else TAG_END
+    return TAG_LIST, bytes([item_type]) + struct.pack(">i", len(tags)) + b"".join(p for _, p in tags)
+
+def nbt_compound(fields):
+    parts = [bytes([t]) + nbt_string(name)[1] + p for name, (t, p) in fields.items()]
+    return TAG_COMPOUND, b"".join(parts) + b"\x00"
+
+def nbt_root(fields):
+    """Готовый NBT-файл: безымянный корневой compound"""
+    return bytes([TAG_COMPOUND]) + b"\x00\x00" + nbt_compound(fields)[1]
+
+# Блоки секции: случайные байты, переложенные на несколько частых id (камень, земля,
+# гравий, воздух, руда) - сжимаются примерно как настоящие, а не в ноль
+BLOCKS = bytes((1, 1, 1, 1, 1, 3, 3, 13, 0, 0, 16, 15)[b % 12] for b in range(256))
+NIBBLES = bytes(0 if b < 200 else b & 0x0F for b in range(256))
+# Предметы без книг: камень, доски, факелы, кирки...
+JUNK_IDS = (1, 4, 5, 17, 50, 257, 264, 265, 266, 280, 331, 352)
+BACKPACK_ID = 5000
+BOOK_ID = 387
+
+def count_around(rnd, density):
+    """Целое число вокруг density: 1.3 - это 1, а в 30% случаев 2"""
+    n = int(density)
+    return n + (rnd.random() < density - n)
+
+def junk_item(rnd, slot):
+    fields = {"id": nbt_short(rnd.choice(JUNK_IDS)), "Count": nbt_byte(rnd.randint(1, 64)),
+              "Damage": nbt_short(0), "Slot": nbt_byte(slot)}
+    if rnd.random() < 0.1:
+        # Зачарования и имя - то, что обход должен пропускать
+        fields["tag"] = nbt_compound({
+            "ench": nbt_list([nbt_compound({"id": nbt_short(rnd.randint(0, 70)),
+                                            "lvl": nbt_short(rnd.randint(1, 5))})
+                              for _ in range(rnd.randint(1, 3))]),
+            "display": nbt_compound({"Name": nbt_string(rnd.choice(WORDS))})})
+    return nbt_compound(fields)
+
+def book_tag(rnd, args):
+    title = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 3)))
+    pages = [random_text(rnd, rnd.randint(1, args.page_size), 0.05)
+             for _ in range(rnd.randint(1, args.pages))]
+    # Часть книг набрана через русификатор - decode.py будет что чинить
+    if rnd.random() < 0.3:
+        title = mojibake(title)
+    return {"title": nbt_string(title), "author": nbt_string(f"Игрок{rnd.randint(1, 500)}"),
+            "pages": nbt_list([nbt_string(p) for p in pages])}
+
+class WorldGen:
+    """Генератор мира: параметры из командной строки + счётчик заложенных книг,
+    чтобы потом сверить его с тем, что нашёл сканер"""
+
+    def __init__(self, args):
+        self.args = args
+        self.rnd = random.Random(args.seed)
+        # Популярные книги (правила сервера, гайды) - лежат в мире во многих копиях
+        self.popular = [book_tag(self.rnd, args) for _ in range(20)]
+        self.planted = {"chunks": 0, "tile_entities": 0, "entities": 0, "players": 0,
+                        "region_books": 0, "player_books": 0}
+
+    def book(self, slot, kind):
+        rnd = self.rnd
+        tag = rnd.choice(self.popular) if rnd.random() < self.args.dup_share else book_tag(rnd, self.args)
+        self.planted[kind] += 1
+        return nbt_compound({"id": nbt_short(BOOK_ID), "Count": nbt_byte(1), "Damage": nbt_short(0),
+                             "Slot": nbt_byte(slot), "tag": nbt_compound(tag)})
+
+    def items(self, slots, kind):
+        """Содержимое контейнера или инвентаря: хлам, иногда книга, иногда рюкзак с книгой"""
+        rnd, args = self.rnd, self.args
+        items = [junk_item(rnd, slot) for slot in range(rnd.randint(0, slots // 2))]
+        if rnd.random() < args.book_density:
+            items.append(self.book(len(items), kind))
+        if rnd.random() < args.nested:
+            inner = [junk_item(rnd, 0), self.book(1, kind)]
+            items.append(nbt_compound({"id": nbt_short(BACKPACK_ID), "Count": nbt_byte(1),
+                                       "Damage": nbt_short(0), "Slot": nbt_byte(len(items)),
+                                       "tag": nbt_compound({"Items": nbt_list(inner)})}))
+        return nbt_list(items)
+
+    def entity_base(self, x, y, z):
+        rnd = self.rnd
+        return {"Pos": nbt_list([nbt_double(x), nbt_double(y), nbt_double(z)]),
+                "Motion": nbt_list([nbt_double(0.0)] * 3),
+                "Rotation": nbt_list([nbt_float(rnd.uniform(0, 360)), nbt_float(0.0)]),
+                "Health": nbt_short(20), "UUIDMost": nbt_long(rnd.getrandbits(63)),
+                "UUIDLeast": nbt_long(rnd.getrandbits(63))}
+
+    def chunk(self, cx, cz):
+        rnd, args = self.rnd, self.args
+        tes = []
+        for _ in range(count_around(rnd, args.te_density)):
+            pos = {"x": nbt_int(cx * 16 + rnd.randrange(16)), "y": nbt_int(rnd.randrange(5, 120)),
+                   "z": nbt_int(cz * 16 + rnd.randrange(16))}
+            if rnd.random() < 0.3:
+                text = {f"Text{i}": nbt_string(rnd.choice(WORDS)) for i in range(1, 5)}
+                tes.append(nbt_compound({"id": nbt_string("Sign"), **pos, **text}))
+            else:
+                tes.append(nbt_compound({"id": nbt_string("Chest"), **pos,
+                                         "Items": self.items(27, "region_books")}))
+        ents = []
+        for _ in range(count_around(rnd, args.entity_density)):
+            base = self.entity_base(cx * 16 + rnd.random() * 16, rnd.uniform(5, 120),
+                                    cz * 16 + rnd.random() * 16)
+            if rnd.random() < 0.5:
+                # Выпавший предмет
+                item = self.book(0, "region_books") if rnd.random() < args.book_density else junk_item(rnd, 0)
+                ents.append(nbt_compound({"id": nbt_string("Item"), **base, "Item": item,
+                                          "Age": nbt_short(rnd.randrange(6000))}))
+            else:
+                attrs = [nbt_compound({"Name": nbt_string("generic.maxHealth"), "Base": nbt_double(20.0)}),
+                         nbt_compound({"Name": nbt_string("generic.movementSpeed"), "Base": nbt_double(0.23)})]
+                ents.append(nbt_compound({"id": nbt_string("Zombie"), **base,
+                                          "Equipment": nbt_list([nbt_compound({})] * 5),
+                                          "Attributes": nbt_list(attrs)}))
+        sections = [nbt_compound({"Y": nbt_byte(y),
+                                  "Blocks": nbt_byte_array(rnd.randbytes(4096).translate(BLOCKS)),
+                                  "Data": nbt_byte_array(rnd.randbytes(2048).translate(NIBBLES)),
+                                  "SkyLight": nbt_byte_array(b"\xff" * 2048),
+                                  "BlockLight": nbt_byte_array(bytes(2048))})
+                    for y in range(args.sections)]
+        self.planted["chunks"] += 1
+        self.planted["tile_entities"] += len(tes)
+        self.planted["entities"] += len(ents)
+        return nbt_root({"Level": nbt_compound({
+            "xPos": nbt_int(cx), "zPos": nbt_int(cz), "LastUpdate": nbt_long(rnd.randrange(1 << 30)),
+            "TerrainPopulated": nbt_byte(1), "Biomes": nbt_byte_array(bytes(256)),
+            "HeightMap": nbt_int_array([64] * 256), "Sections": nbt_list(sections),
+            "Entities": nbt_list(ents), "TileEntities": nbt_list(tes), "TileTicks": nbt_list([])})})
+
+    def region(self, path, rx, rz):
+        rnd, args = self.rnd, self.args
+        locations = bytearray(SECTOR)
+        timestamps = bytearray(SECTOR)
+        body = []
+        sector = 2
+        for idx in sorted(rnd.sample(range(1024), min(args.chunks, 1024))):
+            raw = self.chunk(rx * 32 + idx % 32, rz * 32 + idx // 32)
+            if rnd.random() < args.gzip:
+                comp, data = GZIP, gzip.compress(raw)
+            else:
+                comp, data = ZLIB, zlib.compress(raw)
+            payload = struct.pack(">IB", len(data) + 1, comp) + data
+            count = -(-len(payload) // SECTOR)
+            body.append(payload + bytes(count * SECTOR - len(payload)))
+            struct.pack_into(">I", locations, idx * 4, (sector << 8) | count)
+            struct.pack_into(">I", timestamps, idx * 4, 1600000000 + rnd.randrange(1 << 20))
+            sector += count
+        path.write_bytes(bytes(locations) + bytes(timestamps) + b"".join(body))
+
+    def regions(self, region_dir, count):
+        region_dir.mkdir(parents=True, exist_ok=True)
+        side = math.ceil(math.sqrt(count))
+        for i in range(count):
+            rx, rz = i % side - side // 2, i // side - side // 2
+            self.region(region_dir / f"r.{rx}.{rz}.mca", rx, rz)
+
+    def player(self):
+        rnd = self.rnd
+        self.planted["players"] += 1
+        base = self.entity_base(rnd.uniform(-500, 500), 64.0, rnd.uniform(-500, 500))
+        return nbt_root({**base, "Inventory": self.items(36, "player_books"),
+                         "EnderItems": self.items(27, "player_books"),
+                         "abilities": nbt_compound({"flying": nbt_byte(0), "walkSpeed": nbt_float(0.1)})})
+
+    def world(self, root):
+        """Пишет мир в root: регионы обычного мира и ада, файлы игроков, level.dat"""
+        args = self.args
+        self.regions(root / "region", args.regions)
+        if args.nether:
+            self.regions(root / "DIM-1" / "region", args.nether)
+        players = root / "playerdata"
+        players.mkdir(parents=True, exist_ok=True)
+        for _ in range(args.players):
+            name = uuid.UUID(int=self.rnd.getrandbits(128))
+            (players / f"{name}.dat").write_bytes(gzip.compress(self.player()))
+        level = nbt_root({"Data": nbt_compound({
+            "LevelName": nbt_string("BenchWorld"), "RandomSeed": nbt_long(args.seed),
+            "Player": nbt_compound({"Inventory": self.items(36, "player_books")})})})
+        (root / "level.dat").write_bytes(gzip.compress(level))
+
+WORLD_PARAMS = ("seed", "regions", "nether", "chunks", "sections", "te_density", "entity_density",
+                "book_density", "nested", "dup_share", "gzip", "players", "pages", "page_size")
+
+def generate_world(args, root: Path) -> dict:
+    """Генерирует мир и кладёт рядом bench_world.json: параметры и сколько чего заложено"""
+    start = time.perf_counter()
+    gen = WorldGen(args)
+    gen.world(root)
+    info = {"params": {k: getattr(args, k) for k in WORLD_PARAMS}, "planted": gen.planted,
+            "bytes": sum(f.stat().st_size for f in root.rglob("*") if f.is_file()),
+            "seconds": round(time.perf_counter() - start, 2)}
+    with open(root / "bench_world.json", "w", encoding="utf-8") as f:
+        json.dump(info, f, ensure_ascii=False, indent=1)
+    return info
+
+def peak_rss_mb(who):
+    """Пиковая память процесса (или его завершившихся детей) в МиБ"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    # Linux отдаёт КиБ, macOS - байты
+    return round(peak / (1 << 20 if sys.platform == "darwin" else 1 << 10), 1)
+
+def rate(n, seconds):
+    return round(n / seconds, 1) if seconds else None
+
+def run_phase(phase, world, out, jobs, prefilter, pipeline=None):
+    """Одна фаза скана в свежем процессе, чтобы пиковая память не тянулась из прошлых фаз"""
+    # Строка в лог на каждую книгу мерила бы скорость терминала, а не сканера
+    book.log.setLevel(logging.WARNING)
+    out = Path(out)
+    if phase == "decode":
+        books = len(open_sink(out, "r").keys())
+        fixed = out.with_name(out.stem + "_fixed" + out.suffix)
+        sys.argv = ["decode.py", "-i", str(out), "-o", str(fixed), "-j", str(jobs)]
+        start = time.perf_counter()
+        with open(os.devnull, "w", encoding="utf-8") as devnull, redirect_stdout(devnull):
+            decode.main()
+        seconds = time.perf_counter() - start
+        result = {"books": books, "books_per_sec": rate(books, seconds),
+                  "unique": len(open_sink(fixed, "r").keys())}
+    else:
+        pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+        scanner = book.Scanner(world, open_sink(out, "w"), pool, prefilter, pipeline=pipeline)
+        start = time.perf_counter()
+        try:
+            scanner.export(("level.dat", "players") if phase == "players" else ("regions",))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            scanner.sink.close()
+        seconds = time.perf_counter() - start
+        found = scanner.books_total + scanner.copies_total
+        result = {"books": found, "books_per_sec": rate(found, seconds), "unique": scanner.books_total,
+                  "phase_seconds": {p: round(t, 3) for p, t in scanner.metrics.times.items()}}
+        if phase == "regions":
+            chunks = scanner.chunks_parsed + scanner.chunks_skipped
+            size = sum(f.stat().st_size for f in Path(world).rglob("*.mca"))
+            result.update(chunks=chunks, chunks_per_sec=rate(chunks, seconds),
+                          chunks_parsed=scanner.chunks_parsed, mb_per_sec=rate(size / (1 << 20), seconds))
+    result.update(seconds=round(seconds, 3), peak_rss_mb=peak_rss_mb(resource and resource.RUSAGE_SELF),
+                  workers_peak_rss_mb=peak_rss_mb(resource and resource.RUSAGE_CHILDREN))
+    return result
+
+def phase_process(conn, *args):
+    try:
+        conn.send(run_phase(*args))
+    finally:
+        conn.close()
+
+def measure(*args):
+    """run_phase в отдельном процессе. fork, где он есть: тогда и воркеры фазы
+    наследуют заглушенный лог и stdout"""
+    ctx = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+    recv, send = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=phase_process, args=(send,) + args)
+    proc.start()
+    send.close()
+    try:
+        result = recv.recv()
+    except EOFError:
+        result = None
+    proc.join()
+    if result is None:
+        raise SystemExit(f"Фаза {args[0]} упала, код {proc.exitcode}")
+    return result
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+PHASES = (("players", "Игроки и level.dat"), ("regions", "Регионы"), ("decode", "decode.py"))
+SUFFIXES = {"dir": "", "jsonl": ".jsonl", "sqlite": ".sqlite"}
+
+def bench_scan(args):
+    with tempfile.TemporaryDirectory(prefix="bookz_bench_") as tmp:
+        tmp = Path(tmp)
+        world = args.world or tmp / "world"
+        if (world / "bench_world.json").exists():
+            with open(world / "bench_world.json", encoding="utf-8") as f:
+                info = json.load(f)
+            print(f"Мир {world} уже сгенерирован, параметры генерации из командной строки не действуют")
+        else:
+            print("Генерирую мир...")
+            info = generate_world(args, world)
+        planted = info["planted"]
+        print(f"Мир: {planted['chunks']} чанков, {planted['players']} игроков, "
+              f"{planted['region_books'] + planted['player_books']} книг, "
+              f"{info['bytes'] / (1 << 20):.1f} МиБ (за {info['seconds']} с)")
+        pipeline = (args.io_threads, args.read_ahead, 2 * args.io_threads) if args.io_threads else None
+        phases = {}
+        for phase, title in PHASES:
+            # Игроки и регионы пишут в разные хранилища, decode читает книги из регионов
+            source = "regions" if phase == "decode" else phase
+            out = tmp / f"{source}{SUFFIXES[args.format]}"
+            r = phases[phase] = measure(phase, world, out, args.jobs, args.prefilter, pipeline)
+            line = f"{title:20s} {r['seconds']:8.2f} с  {r['books_per_sec'] or 0:9.0f} книг/с"
+            if "chunks_per_sec" in r:
+                line += f"  {r['chunks_per_sec'] or 0:9.0f} чанков/с  {r['mb_per_sec'] or 0:6.1f} МиБ/с"
+            if r["peak_rss_mb"] is not None:
+                line += f"  память {r['peak_rss_mb']} МиБ"
+                if args.jobs > 1:
+                    line += f" (+ воркеры {r['workers_peak_rss_mb']} МиБ)"
+            print(line)
+    # Быстрый сканер, потерявший книги, - это не ускорение
+    for phase, kind in (("players", "player_books"), ("regions", "region_books")):
+        if phases[phase]["books"] != planted[kind]:
+            raise SystemExit(f"{phase}: заложено книг {planted[kind]}, найдено {phases[phase]['books']}")
+    result = {"date": datetime.now().isoformat(timespec="seconds"), "commit": git_commit(),
+              "python": platform.python_version(), "platform": platform.platform(),
+              "cpu_count": os.cpu_count(), "world": info,
+              "run": {"jobs": args.jobs, "format": args.format, "prefilter": args.prefilter,
+                      "io_threads": args.io_threads, "read_ahead": args.read_ahead},
+              "phases": phases}
+    save = args.save or RESULTS_DIR / f"scan_{datetime.now():%Y%m%d_%H%M%S}.json"
+    save.parent.mkdir(parents=True, exist_ok=True)
+    with open(save, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=1)
+    print("Результаты сохранены в", save)
+
+COMPARE_METRICS = ("seconds", "books_per_sec", "chunks_per_sec", "mb_per_sec", "peak_rss_mb")
+
+def bench_compare(args):
+    with open(args.old, encoding="utf-8") as f:
+        old = json.load(f)
+    with open(args.new, encoding="utf-8") as f:
+        new = json.load(f)
+    print(f"было:  {old.get('commit')} от {old['date']}")
+    print(f"стало: {new.get('commit')} от {new['date']}")
+    if old["world"]["params"] != new["world"]["params"] or old["run"] != new["run"]:
+        print("ВНИМАНИЕ: прогоны на разных мирах или с разными параметрами")
+    for phase, title in PHASES:
+        if phase not in old["phases"] or phase not in new["phases"]:
+            continue
+        print(title)
+        for metric in COMPARE_METRICS:
+            a, b = old["phases"][phase].get(metric), new["phases"][phase].get(metric)
+            if a is None or b is None:
+                continue
+            change = f"{(b - a) / a * 100:+.1f}%" if a else ""
+            print(f"  {metric:16s} {a:12} -> {b:<12} {change}")
+
+def add_world_args(parser):
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--regions", type=int, default=4, help="регионов в обычном мире")
+    parser.add_argument("--nether", type=int, default=1, help="регионов в DIM-1")
+    parser.add_argument("--chunks", type=int, default=400, help="чанков в регионе (до 1024)")
+    parser.add_argument("--sections", type=int, default=8, help="секций блоков в чанке")
+    parser.add_argument("--te-density", type=float, default=2.0, help="TileEntity на чанк")
+    parser.add_argument("--entity-density", type=float, default=1.0, help="сущностей на чанк")
+    parser.add_argument("--book-density", type=float, default=0.15,
+                        help="доля контейнеров (и выпавших предметов) с книгой")
+    parser.add_argument("--nested", type=float, default=0.05, help="доля контейнеров с рюкзаком, а в нём книга")
+    parser.add_argument("--dup-share", type=float, default=0.3, help="доля книг - копий популярных")
+    parser.add_argument("--gzip", type=float, default=0.1, help="доля чанков, сжатых gzip, а не zlib")
+    parser.add_argument("--players", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=10, help="максимум страниц в книге")
+    parser.add_argument("--page-size", type=int, default=200, help="максимум символов на странице")
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки book.py / decode.py")
+    sub = parser.add_subparsers(dest="what", required=True)
+    enc = sub.add_parser("encoding", help="перекодировка decode.py на больших страницах")
+    enc.add_argument("--pages", type=int, default=200)
+    enc.add_argument("--page-size", type=int, default=20000)
+    enc.add_argument("--seed", type=int, default=1)
+    gen = sub.add_parser("world", help="сгенерировать синтетический мир")
+    gen.add_argument("path", type=Path)
+    add_world_args(gen)
+    scan = sub.add_parser("scan", help="скорость и память book.py и decode.py на синтетическом мире")
+    scan.add_argument("--world", type=Path,
+                      help="готовый мир из bench.py world (или куда его сгенерировать и оставить)")
+    scan.add_argument("-j", "--jobs", type=int, default=1)
+    scan.add_argument("--format", choices=SUFFIXES, default="dir", help="хранилище книг (см. sinks.py)")
+    scan.add_argument("--no-prefilter", dest="prefilter", action="store_false")
+    scan.add_argument("--io-threads", type=int, default=0, help="конвейер чтения и распаковки (см. book.py)")
+    scan.add_argument("--read-ahead", type=int, default=64)
+    scan.add_argument("--save", type=Path, help="куда сохранить результаты (по умолчанию bench_results/)")
+    add_world_args(scan)
+    cmp = sub.add_parser("compare", help="сравнить два прогона scan")
+    cmp.add_argument("old", type=Path)
+    cmp.add_argument("new", type=Path)
+    args = parser.parse_args()
+    if args.what == "encoding":
+        bench_encoding(args)
+    elif args.what == "world":
+        info = generate_world(args, args.path)
+        print(f"Мир записан в {args.path}: {info['planted']}")
+    elif args.what == "scan":
+        bench_scan(args)
+    elif args.what == "compare":
+        bench_compare(args)
+
+if __name__ == "__main__":
+    main()
@@ -1,46 +1,188 @@
-# Зависимость: pip install --upgrade nbtlib
+# Сторонних зависимостей нет: NBT читает свой nbtstream.py
+# Сканер можно встроить в свой код, всё его состояние - в объекте Scanner:
+# Scanner(мир).scan() лениво отдаёт найденные книги с контекстом, Scanner(мир, sink).export()
+# пишет их в хранилище (см. sinks.py). main() ниже - только разбор ключей и вывод
 
 #!/usr/bin/env python3
-import gzip, json, logging, os, struct, zlib
+import argparse, atexit, gzip, hashlib, itertools, json, logging, multiprocessing, os, queue, re, \
+    struct, threading, time, zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
-import nbtlib
-from io import BytesIO
+from metrics import Metrics, Stopwatch
+from nbtstream import read_nbt
+from region import RegionFile, decompress, prefetch
+from sinks import open_sink
+from decode import calculate_book_hash, windowed_imap
 
-# Папки
+# Папки по умолчанию (--world, -o)
 WORLD_DIR   = Path(__file__).with_name("HardcoreMap")
 OUTPUT_DIR  = Path(__file__).with_name("exported_books")
 LOG_FILE    = Path(__file__).with_name("world_fixed.log")
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s  %(message)s',
-                    handlers=[logging.FileHandler(LOG_FILE, encoding="utf-8"),
-                              logging.StreamHandler()])
 log = logging.getLogger("wf")
 
-# Это важно
-books_total = 0
-regions_done = 0
-chunks_te   = 0
+# Имя NBT-тега "pages" как оно лежит в байтах (длина u16 + имя). Без него is_book() ничего
+# не найдёт, поэтому чанк, где этих байт нет, можно не разбирать вовсе
+BOOK_SIGNATURE = b"\x00\x05pages"
+# Заголовок списка TileEntities: тип 9 + имя, за ним тип элементов и длина int32
+TE_SIGNATURE = b"\x09\x00\x0cTileEntities"
+# Из чанка разбираем только то, где могут лежать предметы, остальное пропускается
+CHUNK_SELECT = {"Level": {"TileEntities": None, "Entities": None}}
+# id записанной книги: числовой в 1.7.10 и строковые на всякий случай
+BOOK_IDS = frozenset({387, "387", "minecraft:written_book", "written_book"})
+# Ключи, под которыми предметов не бывает - обход туда не спускается (--skip-keys)
+SKIP_KEYS = frozenset({"Attributes", "AttributeModifiers", "ActiveEffects", "CustomPotionEffects",
+                       "ench", "StoredEnchantments", "display", "Fireworks", "Explosion",
+                       "abilities", "Pos", "Motion", "Rotation", "pages"})
+# Что есть в мире: level.dat, файлы игроков, регионы. Scanner может сканировать не всё
+PARTS = ("level.dat", "players", "regions")
+
+def setup_logging(verbose=False):
+    """Лог пишет отдельный поток, сканер и воркеры только кладут записи в очередь.
+    Каждая книга - в файл, в консоль - прогресс (с verbose - и книги)"""
+    log_queue = multiprocessing.Queue(-1)
+    formatter = logging.Formatter('%(asctime)s  %(message)s')
+    file_handler = logging.FileHandler(LOG_FILE, encoding="utf-8")
+    console = logging.StreamHandler()
+    console.setLevel(logging.DEBUG if verbose else logging.INFO)
+    for handler in (file_handler, console):
+        handler.setFormatter(formatter)
+    listener = QueueListener(log_queue, file_handler, console, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    init_worker(log_queue)
+    return log_queue
+
+def init_worker(log_queue):
+    """Логирование процесса (главного или воркера пула) через общую очередь"""
+    root = logging.getLogger()
+    root.handlers[:] = [QueueHandler(log_queue)]
+    root.setLevel(logging.DEBUG)
 
 def sanitize(n: str) -> str:
-    return n.replace("<", "_").replace(">", "_").replace(":", "_").replace("?", "_")[:100]
+    """Название книги -> часть имени файла: всё, что нельзя в пути (в т.ч. / и управляющие), на _"""
+    return re.sub(r'[<>:"/\\|?*\x00-\x1f]', "_", n)[:100]
+
+def load_manifest(path: Path) -> dict:
+    if not path.exists():
+        log.warning("Манифест %s не найден, сканирую всё заново", path)
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def save_manifest(manifest: dict, path: Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp, path)
+
+def load_checkpoint(path: Path):
+    """Состояние из журнала чекпойнтов (см. Scanner.save_checkpoint). Запись, оборванная
+    падением посреди записи, не учитывается"""
+    if not path.exists():
+        return None
+    state = None
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if state is None:
+                state = {"options": record["options"], "done": [], "book_index": {}, "touched_books": [],
+                         "manifest": {"books_total": 0, "regions": {}, "files": {}, "books": {}},
+                         "metrics": {"regions": {}}}
+            apply_checkpoint(state, record)
+    return state
+
+def apply_checkpoint(state, record):
+    """Добавляет к состоянию запись журнала: счётчики и sink - как в записи, остальное дописывается.
+    None в манифесте - запись удалена"""
+    state["sink"] = record["sink"]
+    state["counters"] = record["counters"]
+    state["done"].extend(record["done"])
+    state["book_index"].update(record["book_index"])
+    state["touched_books"].extend(record["touched_books"])
+    for section, entries in record["manifest"].items():
+        for key, value in entries.items():
+            if value is None:
+                state["manifest"][section].pop(key, None)
+            else:
+                state["manifest"][section][key] = value
+    regions = state["metrics"]["regions"]
+    regions.update(record["metrics"]["regions"])
+    state["metrics"] = dict(record["metrics"], regions=regions)
+
+def parse_shard(text: str):
+    """'2/4' -> (2, 4), для --shard"""
+    try:
+        i, n = (int(x) for x in text.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"ожидается i/N, например 2/4, а не {text!r}")
+    if not 1 <= i <= n:
+        raise argparse.ArgumentTypeError(f"номер шарда должен быть от 1 до {n}")
+    return i, n
+
+def shard_of(key: str, count: int) -> int:
+    """Номер шарда (с 1) для источника: crc32 пути от корня мира, на любой машине одинаковый"""
+    return zlib.crc32(key.encode("utf-8")) % count + 1
+
+def parse_box(text: str, chunks=False):
+    """'[DIM:]X1,Z1,X2,Z2' -> (измерение, (cx1, cz1, cx2, cz2)) в чанках, для --box и --chunk-box.
+    Без DIM - обычный мир. Координаты блоков (рамка расширяется до целых чанков), с chunks - чанков"""
+    dim, _, coords = text.rpartition(":")
+    try:
+        dim = dim.upper()
+        dim = int(dim[3:] if dim.startswith("DIM") else dim) if dim else 0
+        x1, z1, x2, z2 = (int(c) for c in coords.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"ожидается [DIM:]X1,Z1,X2,Z2, например -1:-100,-100,100,100, а не {text!r}")
+    if not chunks:
+        x1, z1, x2, z2 = x1 >> 4, z1 >> 4, x2 >> 4, z2 >> 4
+    return dim, (min(x1, x2), min(z1, z2), max(x1, x2), max(z1, z2))
+
+def player_id(text: str) -> str:
+    """UUID игрока без дефисов и в нижнем регистре - так сравниваются --player и имена файлов"""
+    return text.replace("-", "").lower()
 
-def save_book(b: dict, idx: int):
-    (OUTPUT_DIR / "books_json").mkdir(parents=True, exist_ok=True)
-    fname = OUTPUT_DIR / "books_json" / f"book_{idx:05d}_{sanitize(b['title'])}.json"
-    with open(fname, "w", encoding="utf-8") as f:
-        json.dump(b, f, ensure_ascii=False, indent=1)
+def dimension_of(world_dir: Path) -> int:
+    """Номер измерения по имени папки: DIM-1 -> -1, DIM7 -> 7, сам мир - 0"""
+    m = re.fullmatch(r"DIM(-?\d+)", world_dir.name)
+    return int(m.group(1)) if m else 0
+
+def region_xz(rfile: Path):
+    """Координаты региона из имени r.X.Z.mca, None - имя не такое"""
+    try:
+        _, x, z = rfile.stem.split(".")
+        return int(x), int(z)
+    except ValueError:
+        return None
 
 def is_book(item) -> bool:
     if not item: return False
+    # Сначала дешёвая проверка id, tag смотрим только у книг.
+    # У модовых предметов id бывает и составным (Compound, список) - такие не книги
     raw = item.get("id")
-    id_ = str(int(raw)) if isinstance(raw, (int, nbtlib.tag.Short, nbtlib.tag.Int)) else str(raw)
-    return id_ in ("387", "minecraft:written_book", "written_book") and "tag" in item and "pages" in item["tag"] #todo: writable_book но хз какая там структура
+    if not isinstance(raw, (int, str)) or raw not in BOOK_IDS:
+        return False
+    tag = item.get("tag")
+    return isinstance(tag, dict) and "pages" in tag #todo: writable_book но хз какая там структура
+
+def describe_container(item) -> str:
+    """Как назвать предмет-контейнер (рюкзак, сумку...) в отчёте"""
+    if "Slot" in item:
+        return f"{item['id']} (слот {item['Slot']})"
+    return str(item["id"])
 
-def extract_book(item, loc: str):
+def extract_book(item, loc: str, parents=()):
     tag = item["tag"]
     pages = [str(p) for p in tag.get("pages", [])]
-    return {
+    b = {
         "title": str(tag.get("title", "Без названия")),
         "author": str(tag.get("author", "Неизвестен")),
         "pages": pages,
@@ -48,181 +190,328 @@ def extract_book(item, loc: str):
         "count": int(item.get("Count", 1)),
         "found_at": datetime.now().isoformat(timespec="seconds")
     }
+    # Книга лежит в предмете (рюкзак, сумка, предмет в предмете) - от внешнего к внутреннему
+    if parents:
+        b["inside"] = [describe_container(p) for p in parents]
+    return b
 
-def find_itemstacks(tag):
-    """Рекурсивно ищет все ItemStack в NBT-теге"""
-    try:
-        if isinstance(tag, nbtlib.tag.Compound):
+def find_itemstacks(tag, skip=SKIP_KEYS):
+    """Ищет все ItemStack в NBT-теге. Обход без рекурсии, через свой стек, в том же
+    порядке, что и рекурсивный. Отдаёт (ItemStack, цепочка ItemStack, в которых он лежит)"""
+    stack = [(tag, ())]
+    while stack:
+        node, parents = stack.pop()
+        if isinstance(node, dict):
             # Проверяем, является ли тег ItemStack
-            if 'id' in tag and 'Count' in tag:
-                yield tag
-            # Рекурсивно обходим вложенные теги
-            for key, subtag in tag.items():
-                yield from find_itemstacks(subtag)
-        elif isinstance(tag, nbtlib.tag.List):
-            for subtag in tag:
-                yield from find_itemstacks(subtag)
-    except Exception as e:
-        log.warning(f"Ошибка при поиске ItemStack: {e}")
-
-def get_root_tag(nbt_file):
-    """Универсально получает корневой тег для разных версий nbtlib"""
-    if hasattr(nbt_file, 'root'):
-        return nbt_file.root
-    return nbt_file
+            if 'id' in node and 'Count' in node:
+                yield node, parents
+                parents = parents + (node,)
+            children = [(sub, parents) for key, sub in node.items()
+                        if key not in skip and isinstance(sub, (dict, list))]
+        elif node and isinstance(node[0], (dict, list)):
+            # Списки чисел и строк пропускаем целиком
+            children = [(sub, parents) for sub in node]
+        else:
+            continue
+        children.reverse()
+        stack.extend(children)
 
-def load_nbt_file(filepath):
+def load_nbt_file(filepath, watch=None):
     """Загружает NBT с автоматическим определением сжатия"""
+    watch = watch or Stopwatch()
     try:
         # Сначала пробуем открыть как обычный файл
         with open(filepath, 'rb') as f:
             data = f.read()
+        watch.lap("read")
         
         # Пробуем распаковать как gzip
         try:
-            decompressed = gzip.decompress(data)
-            file_obj = BytesIO(decompressed)
+            data = gzip.decompress(data)
         except:
             # Если не gzip, используем исходные данные
-            file_obj = BytesIO(data)
-            
-        nbt_file = nbtlib.File.parse(file_obj)
-        return get_root_tag(nbt_file)
+            pass
+        watch.lap("decompress")
+
+        root_tag = read_nbt(data)
+        watch.lap("parse")
+        return root_tag
     except Exception as e:
         log.error(f"Ошибка при загрузке NBT из {filepath}: {e}")
         raise
 
-def scan_level_dat(world_dir: Path):
-    global books_total  # Это важно
-    level_dat_file = world_dir / "level.dat"
-    if not level_dat_file.exists():
-        return
+def books_in(root_tag, loc: str, skip=SKIP_KEYS) -> list:
+    """Все записанные книги внутри тега"""
+    return [extract_book(item, loc, parents) for item, parents in find_itemstacks(root_tag, skip)
+            if is_book(item)]
+
+def call_job(job):
+    func, args = job
+    return func(*args)
+
+def run_jobs(func, tasks, pool=None, window=64):
+    """Раздаёт задания (кортежи аргументов) пулу процессов или выполняет тут же.
+    Результаты в исходном порядке. В пуле не больше window заданий сразу (окно больше числа
+    процессов, чтобы они не простаивали) - иначе при медленном потребителе scan() книги целых
+    регионов скопятся в памяти"""
+    if pool is None:
+        return itertools.starmap(func, tasks)
+    return windowed_imap(call_job, ((func, task) for task in tasks), pool, window)
+
+def scan_player_file(dat: Path, world_name: str, skip=SKIP_KEYS):
+    """Книги из одного файла игрока. Выполняется в воркере. Возвращает (книги, время по фазам),
+    книги None - файл не прочитался"""
+    watch = Stopwatch()
     try:
-        root_tag = load_nbt_file(level_dat_file)
-        world_name = world_dir.name
-        loc = f"{world_name}: level.dat"
-        for item in find_itemstacks(root_tag):
-            if is_book(item):
-                b = extract_book(item, loc)
-                books_total += 1
-                save_book(b, books_total)
-                log.info('КНИГА #%d  "%s" (%s)  –  %s', books_total, b["title"], b["author"], loc)
+        root_tag = load_nbt_file(dat, watch)
+        uuid = dat.stem
+        loc = f"{world_name}: player:{uuid}"
+        books = books_in(root_tag, loc, skip)
+        watch.lap("walk")
+        return books, watch.times
     except Exception as e:
-        log.error(f"Ошибка при обработке {level_dat_file}: {e}")
+        log.error(f"Ошибка при обработке файла игрока {dat}: {e}")
+        return None, watch.times
 
-def scan_players(world_dir: Path):
-    global books_total  # Это важно
-    playerdata_dir = world_dir / "playerdata"
-    if not playerdata_dir.exists():
-        return
-    for dat in playerdata_dir.glob("*.dat"):
+def has_tile_entities(raw: bytes) -> bool:
+    """Есть ли в чанке хоть одна TileEntity - без разбора NBT, по длине списка"""
+    pos = raw.find(TE_SIGNATURE)
+    if pos < 0 or pos + len(TE_SIGNATURE) + 5 > len(raw):
+        return False
+    return struct.unpack_from(">i", raw, pos + len(TE_SIGNATURE) + 1)[0] > 0
+
+def forget_stamp(table, known, key):
+    """Источник не удалось учесть - в таблице штампов остаётся прошлый штамп (или никакого),
+    и следующий инкрементальный скан прочитает его снова"""
+    if key in known:
+        table[key] = known[key]
+    else:
+        table.pop(key, None)
+
+def chunks_in_area(region, entries, area, known, table):
+    """Слоты из entries, чанки которых попадают в рамки area. Остальные не читаются,
+    в table для них то, что было известно с прошлого запуска"""
+    inside = []
+    for entry in entries:
+        cx, cz = region.chunk_coords(entry[0])
+        if any(x1 <= cx <= x2 and z1 <= cz <= z2 for x1, z1, x2, z2 in area):
+            inside.append(entry)
+        elif str(entry[0]) in known:
+            table[str(entry[0])] = known[str(entry[0])]
+    return inside
+
+def region_chunks(region, entries, known, table, stats, watch):
+    """Чанки региона по очереди в одном потоке: (номер, распакованные данные или None,
+    если не распаковались). Неизменившиеся чанки только попадают в table"""
+    # Чанки в порядке расположения на диске, данные - срезы mmap без копирования
+    for idx, sector_offset, _ in entries:
+        stats["chunks"] += 1
+        key = str(idx)
+        stamp = region.timestamp(idx)
+        old = known.get(key)
+        if old and old[0] == stamp:
+            table[key] = old
+            stats["chunks_unchanged"] += 1
+            continue
         try:
-            root_tag = load_nbt_file(dat)
-            uuid = dat.stem
-            world_name = world_dir.name
-            loc = f"{world_name}: player:{uuid}"
-            for item in find_itemstacks(root_tag):
-                if is_book(item):
-                    b = extract_book(item, loc)
-                    books_total += 1
-                    save_book(b, books_total)
-                    log.info('КНИГА #%d  "%s" (%s)  –  %s', books_total, b["title"], b["author"], loc)
+            chunk = region.read(idx, sector_offset)
+        except OSError as e:
+            log.warning(f"Не удалось прочитать внешний чанк {idx} в регионе {region.path}: {e}")
+            continue
+        if chunk is None:
+            continue
+        comp, data = chunk
+        stats["read_bytes"] += len(data)
+        digest = hashlib.blake2b(data, digest_size=8).hexdigest()
+        table[key] = [stamp, digest]
+        watch.lap("read")
+        # Чанк пересохранён, но не изменился
+        if old and old[1] == digest:
+            stats["chunks_unchanged"] += 1
+            continue
+        try:
+            raw = decompress(comp, data)
         except Exception as e:
-            log.error(f"Ошибка при обработке файла игрока {dat}: {e}")
+            log.warning(f"Ошибка распаковки чанка {idx} в регионе {region.path}: {e}")
+            raw = None
+        finally:
+            watch.lap("decompress")
+        del chunk, data  # срезы mmap больше не нужны
+        yield idx, raw
 
-def scan_world_regions(world_dir: Path):
-    global books_total, regions_done, chunks_te  # Это важно
-    region_dir = world_dir / "region"
-    if not region_dir.exists():
-        return
-    for rfile in sorted(region_dir.glob("*.mca")):
-        log.info("Сканирую регион %s в мире %s", rfile.name, world_dir.name)
-        with open(rfile, "rb") as f:
-            locs = f.read(4096)
-            for idx in range(1024):
-                off = idx*4
-                entry = locs[off:off+4]
-                if entry == b"\x00\x00\x00\x00": 
+def timed_decompress(comp, data):
+    start = time.perf_counter()
+    try:
+        return decompress(comp, data), time.perf_counter() - start
+    except Exception as e:
+        return e, time.perf_counter() - start
+
+def pipelined_chunks(region, entries, known, table, stats, watch, threads, read_ahead, decompress_ahead):
+    """То же, что region_chunks, но конвейером: поток-читатель идёт по чанкам в порядке
+    на диске и кладёт сжатые данные в очередь (не больше read_ahead), распаковка - в
+    threads потоках (zlib отпускает GIL, не больше decompress_ahead чанков разом),
+    разбор - в вызывающем потоке. Порядок чанков тот же, что у region_chunks"""
+    chunks = queue.Queue(read_ahead)
+    stop = threading.Event()
+    reader_watch = Stopwatch()
+
+    def reader():
+        try:
+            for idx, sector_offset, sector_count in entries:
+                if stop.is_set():
+                    return
+                stats["chunks"] += 1
+                key = str(idx)
+                stamp = region.timestamp(idx)
+                old = known.get(key)
+                if old and old[0] == stamp:
+                    table[key] = old
+                    stats["chunks_unchanged"] += 1
+                    continue
+                try:
+                    chunk = region.fetch(idx, sector_offset, sector_count)
+                except OSError as e:
+                    log.warning(f"Не удалось прочитать чанк {idx} в регионе {region.path}: {e}")
                     continue
-                sector_offset = ((entry[0]<<16)|(entry[1]<<8)|entry[2]) & 0xFFFFFF
-                sector_count  = entry[3]&0xFF
-                if sector_offset==0 or sector_count==0: 
+                if chunk is None:
                     continue
-                f.seek(sector_offset*4096)
-                head = f.read(5)
-                if len(head) < 5: 
+                comp, data = chunk
+                stats["read_bytes"] += len(data)
+                digest = hashlib.blake2b(data, digest_size=8).hexdigest()
+                table[key] = [stamp, digest]
+                reader_watch.lap("read")
+                if old and old[1] == digest:
+                    stats["chunks_unchanged"] += 1
                     continue
-                length, comp = struct.unpack(">IB", head)
-                if length < 1: 
+                chunks.put((idx, comp, data))
+                # Ожидание места в очереди - не чтение
+                reader_watch.reset()
+        finally:
+            chunks.put(None)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    pending = deque()
+    done = False
+    try:
+        with ThreadPoolExecutor(threads) as executor:
+            while True:
+                # Дозаполняем распаковку: ждём читателя, только если распаковывать больше нечего
+                while not done and len(pending) < decompress_ahead:
+                    try:
+                        item = chunks.get(block=not pending)
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        done = True
+                        break
+                    idx, comp, data = item
+                    pending.append((idx, executor.submit(timed_decompress, comp, data)))
+                if not pending:
+                    break
+                idx, future = pending.popleft()
+                raw, seconds = future.result()
+                watch.times["decompress"] += seconds
+                watch.lap("wait")
+                if isinstance(raw, Exception):
+                    log.warning(f"Ошибка распаковки чанка {idx} в регионе {region.path}: {raw}")
+                    raw = None
+                yield idx, raw
+    finally:
+        stop.set()
+        # Освобождаем читателя, если он ждёт места в очереди
+        while thread.is_alive():
+            try:
+                chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        watch.times["read"] += reader_watch.times["read"]
+
+def scan_region_file(rfile: Path, world_name: str, prefilter: bool = True, known: dict = None,
+                     skip=SKIP_KEYS, pipeline=None, prefetch_next=None, area=None):
+    """Сканирует один .mca файл. Выполняется в воркере, глобальные счётчики не трогает.
+    known - таблица чанков этого региона из прошлого манифеста: чанки с тем же
+    штампом времени или тем же хешем сжатых данных не разбираются.
+    pipeline - (потоков распаковки, очередь чтения, очередь распаковки) для конвейера,
+    None - всё по очереди в одном потоке. prefetch_next - следующий регион, его ОС
+    может начать читать заранее. area - рамки (--box), только их чанки и читаются.
+    Возвращает ({чанк: книги} для разобранных чанков, счётчики и время по фазам,
+    новая таблица чанков)"""
+    found = {}
+    table = {}
+    known = known or {}
+    stats = {"chunks_te": 0, "chunks_parsed": 0, "chunks_skipped": 0, "chunks_unchanged": 0,
+             "chunks": 0, "read_bytes": 0, "raw_bytes": 0}
+    log.debug("Сканирую регион %s в мире %s", rfile.name, world_name)
+    if prefetch_next is not None:
+        prefetch(prefetch_next)
+    watch = Stopwatch()
+    with RegionFile(rfile) as region:
+        entries = region.entries()
+        if area is not None:
+            entries = chunks_in_area(region, entries, area, known, table)
+        if pipeline:
+            chunks = pipelined_chunks(region, entries, known, table, stats, watch, *pipeline)
+        else:
+            chunks = region_chunks(region, entries, known, table, stats, watch)
+        for idx, raw in chunks:
+            if raw is None:
+                # Не распаковался - при следующем скане пробуем снова
+                forget_stamp(table, known, str(idx))
+                continue
+            books = found[str(idx)] = []
+            stats["raw_bytes"] += len(raw)
+
+            # Расчет координат чанка
+            cx, cz = region.chunk_coords(idx)
+
+            try:
+                # Проверяем, что данные не пустые
+                if not raw:
+                    log.warning(f"Пустые данные чанка ({cx},{cz}) в регионе {rfile}")
                     continue
-                data = f.read(length-1)
-                try:
-                    if comp == 2:
-                        raw = zlib.decompress(data)
-                    elif comp == 1:
-                        raw = gzip.decompress(data)
-                    else:
-                        log.warning(f"Неизвестная компрессия {comp} в регионе {rfile}, чанк {idx}")
-                        continue
-                except Exception as e:
-                    log.warning(f"Ошибка распаковки чанка {idx} в регионе {rfile}: {e}")
+
+                # Книг в чанке нет - полный разбор NBT не нужен
+                if prefilter and BOOK_SIGNATURE not in raw:
+                    stats["chunks_skipped"] += 1
+                    if has_tile_entities(raw):
+                        stats["chunks_te"] += 1
+                    watch.lap("parse")
                     continue
+                stats["chunks_parsed"] += 1
 
-                # Расчет координат чанка
-                region_x = int(rfile.stem.split('.')[1])
-                region_z = int(rfile.stem.split('.')[2])
-                cx = (idx % 32) + region_x * 32
-                cz = (idx // 32) + region_z * 32
+                # Только TileEntities и Entities, блоки и свет пропускаются не читая
+                root_tag = read_nbt(raw, CHUNK_SELECT)
+                lvl = root_tag.get("Level", {})
+                watch.lap("parse")
+                containers = 0
+                
+                # Обработка TileEntities
+                for te in lvl.get("TileEntities", []):
+                    te_id = str(te.get("id", "unknown"))
+                    x = te.get("x", 0)
+                    y = te.get("y", 0)
+                    z = te.get("z", 0)
+                    loc = f"{world_name}: {te_id} at ({x},{y},{z})"
+                    books.extend(books_in(te, loc, skip))
+                    containers += 1
 
-                try:
-                    # Проверяем, что данные не пустые
-                    if not raw:
-                        log.warning(f"Пустые данные чанка ({cx},{cz}) в регионе {rfile}")
-                        continue
-                        
-                    # Создаем файловый объект из байтов
-                    file_obj = BytesIO(raw)
-                    nbt_file = nbtlib.File.parse(file_obj)
-                    root_tag = get_root_tag(nbt_file)
-                    lvl = root_tag.get("Level", {})
-                    containers = 0
-                    
-                    # Обработка TileEntities
-                    for te in lvl.get("TileEntities", []):
-                        te_id = str(te.get("id", "unknown"))
-                        x = te.get("x", 0)
-                        y = te.get("y", 0)
-                        z = te.get("z", 0)
-                        world_name = world_dir.name
-                        loc = f"{world_name}: {te_id} at ({x},{y},{z})"
-                        
-                        for item in find_itemstacks(te):
-                            if is_book(item):
-                                b = extract_book(item, loc)
-                                books_total += 1
-                                save_book(b, books_total)
-                                log.info('КНИГА #%d  "%s" (%s)  –  %s', books_total, b["title"], b["author"], loc)
-                        containers += 1
-
-                    # Обработка Entities
-                    for ent in lvl.get("Entities", []):
-                        ent_id = str(ent.get("id", "unknown"))
-                        pos = ent.get("Pos", [0.0, 0.0, 0.0])
-                        world_name = world_dir.name
-                        loc = f"{world_name}: {ent_id} at ({pos[0]:.1f},{pos[1]:.1f},{pos[2]:.1f})"
-                        
-                        for item in find_itemstacks(ent):
-                            if is_book(item):
-                                b = extract_book(item, loc)
-                                books_total += 1
-                                save_book(b, books_total)
-                                log.info('КНИГА #%d  "%s" (%s)  –  %s', books_total, b["title"], b["author"], loc)
-
-                    if containers:
-                        chunks_te += 1
-                except Exception as e:
-                    log.error(f"Ошибка при обработке чанка ({cx},{cz}) в регионе {rfile}: {e}")
-        regions_done += 1
+                # Обработка Entities
+                for ent in lvl.get("Entities", []):
+                    ent_id = str(ent.get("id", "unknown"))
+                    pos = ent.get("Pos", [0.0, 0.0, 0.0])
+                    loc = f"{world_name}: {ent_id} at ({pos[0]:.1f},{pos[1]:.1f},{pos[2]:.1f})"
+                    books.extend(books_in(ent, loc, skip))
+
+                if containers:
+                    stats["chunks_te"] += 1
+                watch.lap("walk")
+            except Exception as e:
+                log.error(f"Ошибка при обработке чанка ({cx},{cz}) в регионе {rfile}: {e}")
+                del found[str(idx)]
+                forget_stamp(table, known, str(idx))
+    stats["times"] = watch.times
+    return found, stats, table
 
 def find_worlds(root_dir: Path):
     """Скрипт рекурсивно жрёт папки"""
@@ -233,24 +522,639 @@ def find_worlds(root_dir: Path):
             worlds.append(current_dir)
     return worlds
 
+def source_order(key: str):
+    """Порядок источников при слиянии: по пути, чанки региона - по номеру"""
+    path, _, idx = key.partition("#")
+    return path, int(idx) if idx else -1
+
+class Scanner:
+    """Сканер одного мира (папки, где find_worlds найдёт миры и измерения).
+    scan() лениво отдаёт найденные книги с контекстом и ничего не пишет, export() пишет их
+    в sink как book.py: нумерация, дедупликация с copies, манифест, чекпойнты.
+    pool - пул процессов, которому раздаются регионы и игроки (None - всё в этом процессе).
+    prev_manifest - манифест прошлого скана: тогда скан инкрементальный, неизменившееся не читается.
+    checkpoint_file - куда export() пишет чекпойнты (продолжение - resume()).
+    Остальное - как ключи book.py"""
+
+    def __init__(self, world, sink=None, pool=None, prefilter=True, skip=SKIP_KEYS, pipeline=None,
+                 dedup=True, shard=None, boxes=None, players=None, prev_manifest=None,
+                 checkpoint_file=None, checkpoint_every=60):
+        self.world = Path(world)
+        self.sink = sink
+        self.pool = pool
+        self.prefilter = prefilter
+        self.skip = skip
+        self.pipeline = pipeline
+        # Дедупликация на лету: хеш содержимого -> ключ уже записанной книги.
+        # Повторные находки не пишутся отдельно, а дописываются в copies этой книги в конце скана
+        self.dedup = dedup
+        self.book_index = {}
+        self.touched_books = set()
+        # (i, N) - берём только свою часть регионов и файлов игроков, ключи книг с меткой шарда,
+        # чтобы выгрузки шардов не пересекались
+        self.shard = shard
+        # Фильтры, None - без фильтра. boxes: измерение -> [(cx1, cz1, cx2, cz2)] в чанках,
+        # players - UUID без дефисов. С любым фильтром сканируется только выбранное: регионы и
+        # чанки из рамок и файлы этих игроков, level.dat не читается. Отсекается до чтения - по
+        # именам файлов и номерам слотов. Про пропущенное остаётся то, что было в прошлом манифесте
+        self.boxes = boxes
+        self.players = players
+        # Манифест скана: штампы чанков и файлов + какие книги откуда взялись
+        # (источник -> список находок [ключ книги, location, count]).
+        # prev_manifest - с прошлого запуска, manifest - пишется сейчас
+        self.incremental = prev_manifest is not None
+        self.prev_manifest = prev_manifest or {}
+        self.manifest = {"books_total": 0, "regions": {}, "files": {}, "books": {}}
+        self.books_total = self.prev_manifest.get("books_total", 0)
+        self.copies_total = 0
+        self.regions_done = 0
+        self.chunks_te = 0
+        self.chunks_parsed = 0
+        self.chunks_skipped = 0
+        self.chunks_unchanged = 0
+        # Время по фазам, счётчики по регионам, прогресс (см. metrics.py)
+        self.metrics = Metrics()
+        # Чекпойнты: между источниками (регион, файл игрока), не чаще раза в checkpoint_every
+        # секунд. done_sources - источники, которые уже полностью учтены. Регион учитывается
+        # целиком, так что прерванный регион при продолжении читается с начала.
+        # Чекпойнт - журнал: в него дописывается только то, что поменялось с прошлой записи
+        # (new_* и changed), целиком состояние пишется один раз в начале
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint_every = checkpoint_every
+        self.last_checkpoint = 0.0
+        self.done_sources = set()
+        self.checkpoint_started = False
+        # Ключи манифеста, изменённые с прошлой записи. dict, а не set - порядок книг в манифесте
+        # важен (первая находка - основная), и в журнале он должен быть тем же
+        self.changed = {"regions": {}, "files": {}, "books": {}}
+        self.new_done = []
+        self.new_index = {}
+        self.new_touched = set()
+        self.resumed = False
+        self.started = False
+        self._worlds = None
+
+    def options(self) -> dict:
+        """Параметры, от которых зависит выгрузка - продолжать чекпойнт можно только с теми же.
+        Через JSON - чтобы сравнивать с тем, что прочитано из чекпойнта"""
+        return json.loads(json.dumps({
+            "incremental": self.incremental, "dedup": self.dedup, "prefilter": self.prefilter,
+            "skip_keys": sorted(self.skip), "shard": self.shard, "boxes": self.boxes,
+            "players": sorted(self.players) if self.players else None}))
+
+    def worlds(self):
+        if self._worlds is None:
+            self._worlds = find_worlds(self.world)
+        return self._worlds
+
+    def source_key(self, path: Path) -> str:
+        """Ключ файла в манифесте - путь относительно папки мира"""
+        return path.relative_to(self.world).as_posix()
+
+    def shard_tag(self) -> str:
+        return f"s{self.shard[0]}of{self.shard[1]}"
+
+    def in_shard(self, path: Path) -> bool:
+        return self.shard is None or shard_of(self.source_key(path), self.shard[1]) == self.shard[0]
+
+    def filtered(self) -> bool:
+        return self.boxes is not None or self.players is not None
+
+    def wanted_player(self, dat: Path) -> bool:
+        return not self.filtered() or self.players is not None and player_id(dat.stem) in self.players
+
+    def region_area(self, rfile: Path, dim: int):
+        """Рамки, которые задевают регион r.X.Z.mca (по имени файла), None - фильтра нет"""
+        if not self.filtered():
+            return None
+        xz = region_xz(rfile)
+        if xz is None:
+            return []
+        rx, rz = xz[0] * 32, xz[1] * 32
+        return [box for box in (self.boxes or {}).get(dim, [])
+                if box[0] <= rx + 31 and box[2] >= rx and box[1] <= rz + 31 and box[3] >= rz]
+
+    def keep_source(self, key: str):
+        """Источник не менялся - его книги с прошлого запуска остаются"""
+        if key in self.prev_manifest.get("books", {}):
+            self.manifest["books"][key] = self.prev_manifest["books"][key]
+            self.changed["books"][key] = None
+
+    def keep_file(self, path: Path):
+        """Файл не читается из-за фильтра - оставляем его штамп и книги с прошлого запуска"""
+        key = self.source_key(path)
+        stamp = self.prev_manifest.get("files", {}).get(key)
+        if stamp is not None:
+            self.manifest["files"][key] = stamp
+            self.changed["files"][key] = None
+            self.keep_source(key)
+
+    def keep_region(self, rel: str):
+        """То же для региона целиком"""
+        table = self.prev_manifest.get("regions", {}).get(rel)
+        if table is not None:
+            self.manifest["regions"][rel] = table
+            self.changed["regions"][rel] = None
+            for idx in table:
+                self.keep_source(f"{rel}#{idx}")
+
+    def forget_source(self, key: str):
+        """Источник (файл или чанк) не прочитался или не все его книги записались: штамп - как
+        в прошлом манифесте, книги оттуда же, следующий инкрементальный скан прочитает его снова"""
+        path, _, idx = key.partition("#")
+        if idx:
+            forget_stamp(self.manifest["regions"].get(path, {}),
+                         self.prev_manifest.get("regions", {}).get(path, {}), idx)
+            self.changed["regions"][path] = None
+        else:
+            forget_stamp(self.manifest["files"], self.prev_manifest.get("files", {}), path)
+            self.changed["files"][path] = None
+
+    def file_unchanged(self, path: Path) -> bool:
+        """Запоминает mtime/размер файла и говорит, можно ли его не перечитывать"""
+        key = self.source_key(path)
+        st = path.stat()
+        stamp = [st.st_mtime_ns, st.st_size]
+        self.manifest["files"][key] = stamp
+        self.changed["files"][key] = None
+        if self.prev_manifest.get("files", {}).get(key) == stamp:
+            self.keep_source(key)
+            return True
+        return False
+
+    def source_done(self, key: str):
+        """Источник полностью учтён - отмечаем и, если пора, пишем чекпойнт"""
+        self.done_sources.add(key)
+        self.new_done.append(key)
+        if self.checkpoint_file is None or self.sink is None:
+            self.clear_changes()
+        elif time.monotonic() - self.last_checkpoint >= self.checkpoint_every:
+            self.save_checkpoint()
+
+    def _level_dat(self, world_dir: Path):
+        level_dat_file = world_dir / "level.dat"
+        key = self.source_key(level_dat_file)
+        if not level_dat_file.exists() or not self.in_shard(level_dat_file) or key in self.done_sources:
+            return
+        if self.filtered():
+            self.keep_file(level_dat_file)
+            return
+        if self.file_unchanged(level_dat_file):
+            return
+        try:
+            watch = Stopwatch()
+            root_tag = load_nbt_file(level_dat_file, watch)
+            world_name = world_dir.name
+            loc = f"{world_name}: level.dat"
+            books = books_in(root_tag, loc, self.skip)
+            watch.lap("walk")
+            self.metrics.player_done(level_dat_file.stat().st_size, len(books), watch.times)
+            yield key, books, {"world": world_name, "dimension": dimension_of(world_dir),
+                               "chunk": None, "player": None}
+        except Exception as e:
+            log.error(f"Ошибка при обработке {level_dat_file}: {e}")
+            self.forget_source(key)
+            self.keep_source(key)
+        self.source_done(key)
+
+    def _players(self, world_dir: Path):
+        playerdata_dir = world_dir / "playerdata"
+        if not playerdata_dir.exists():
+            return
+        files = []
+        for dat in playerdata_dir.glob("*.dat"):
+            if not self.in_shard(dat) or self.source_key(dat) in self.done_sources:
+                continue
+            if not self.wanted_player(dat):
+                self.keep_file(dat)
+            elif not self.file_unchanged(dat):
+                files.append(dat)
+        job = partial(scan_player_file, world_name=world_dir.name, skip=self.skip)
+        for dat, (books, times) in zip(files, run_jobs(job, [(dat,) for dat in files], self.pool)):
+            if books is None:
+                self.forget_source(self.source_key(dat))
+                self.keep_source(self.source_key(dat))
+                books = []
+            self.metrics.player_done(dat.stat().st_size, len(books), times)
+            yield self.source_key(dat), books, {"world": world_dir.name, "dimension": dimension_of(world_dir),
+                                                "chunk": None, "player": dat.stem}
+            self.source_done(self.source_key(dat))
+
+    def _regions(self, world_dir: Path):
+        region_dir = world_dir / "region"
+        if not region_dir.exists():
+            return
+        dim = dimension_of(world_dir)
+        regions = []
+        areas = []
+        for rfile in sorted(region_dir.glob("*.mca")):
+            if not self.in_shard(rfile) or self.source_key(rfile) in self.done_sources:
+                continue
+            area = self.region_area(rfile, dim)
+            if area == []:
+                self.keep_region(self.source_key(rfile))
+                continue
+            regions.append(rfile)
+            areas.append(area)
+        known = self.prev_manifest.get("regions", {})
+        # Пока разбирается регион, ОС может читать с диска следующий
+        tasks = [(rfile, world_dir.name, self.prefilter, known.get(self.source_key(rfile)), self.skip,
+                  self.pipeline, next_rfile, area)
+                 for rfile, next_rfile, area in zip(regions, regions[1:] + [None], areas)]
+        for rfile, (found, stats, table) in zip(regions, run_jobs(scan_region_file, tasks, self.pool)):
+            rel = self.source_key(rfile)
+            self.manifest["regions"][rel] = table
+            self.changed["regions"][rel] = None
+            rx, rz = region_xz(rfile) or (0, 0)
+            # list: если книга не запишется, штамп её чанка уберётся из table по ходу
+            for idx in list(table):
+                if idx in found:
+                    n = int(idx)
+                    yield f"{rel}#{idx}", found[idx], {"world": world_dir.name, "dimension": dim,
+                                                       "chunk": (n % 32 + rx * 32, n // 32 + rz * 32),
+                                                       "player": None}
+                else:
+                    self.keep_source(f"{rel}#{idx}")
+            self.chunks_te += stats["chunks_te"]
+            self.chunks_parsed += stats["chunks_parsed"]
+            self.chunks_skipped += stats["chunks_skipped"]
+            self.chunks_unchanged += stats["chunks_unchanged"]
+            self.regions_done += 1
+            self.metrics.region_done(rel, rfile.stat().st_size, stats, sum(len(b) for b in found.values()))
+            log.info("Регион %s (%s): %d чанков | %s", rfile.name, world_dir.name, stats["chunks"],
+                     self.metrics.progress())
+            self.source_done(rel)
+
+    def start(self):
+        """Scanner - на один проход: манифест, счётчики и готовые источники копятся за проход,
+        второй scan()/export() ничего бы не нашёл. Для нового скана - новый Scanner"""
+        if self.started:
+            raise RuntimeError("Scanner уже отработал, для нового скана нужен новый Scanner")
+        self.started = True
+
+    def sources(self, parts=PARTS):
+        """(источник, его книги, контекст) по каждому прочитанному источнику - и для тех,
+        где книг нет. Неизменившиеся (при prev_manifest) и отфильтрованные не отдаются,
+        в манифест идёт то, что было про них известно"""
+        self.start()
+        yield from self._sources(parts)
+
+    def _sources(self, parts):
+        # Прогресс и ETA считаются по суммарному размеру регионов
+        if "regions" in parts:
+            self.metrics.plan([rfile for world_dir in self.worlds()
+                               for rfile in (world_dir / "region").glob("*.mca")
+                               if self.in_shard(rfile)
+                               and self.region_area(rfile, dimension_of(world_dir)) != []])
+        for world_dir in self.worlds():
+            log.info(f"Сканирую мир: {world_dir}")
+            if "level.dat" in parts:
+                yield from self._level_dat(world_dir)
+            if "players" in parts:
+                yield from self._players(world_dir)
+            if "regions" in parts:
+                yield from self._regions(world_dir)
+
+    def scan(self, parts=PARTS):
+        """Найденные книги по одной, лениво, по порядку источников: {"book": книга,
+        "source": источник в манифесте ("region/r.0.0.mca#37", "playerdata/<uuid>.dat"),
+        "world": папка мира, "dimension": измерение, "chunk": (cx, cz) или None,
+        "player": UUID или None}. В sink ничего не пишется"""
+        for source, books, context in self.sources(parts):
+            for b in books:
+                yield dict(context, book=b, source=source)
+
+    def save_book(self, b: dict, idx: int) -> str:
+        """Сохраняет книгу и возвращает её ключ (для папки - имя файла без .json)"""
+        if self.shard:
+            key = f"book_{self.shard_tag()}_{idx:05d}_{sanitize(b['title'])}"
+        else:
+            key = f"book_{idx:05d}_{sanitize(b['title'])}"
+        self.sink.put(key, b)
+        return key
+
+    def write_books(self, books, source: str):
+        """Единственный писатель: нумерует и сохраняет книги, пришедшие от воркеров"""
+        start = time.perf_counter()
+        for b in books:
+            h = calculate_book_hash(b) if self.dedup else None
+            key = self.book_index.get(h)
+            if key is None:
+                try:
+                    key = self.save_book(b, self.books_total + 1)
+                except Exception as e:
+                    # Одна книга, которую не удалось записать, не должна ронять весь скан
+                    log.error(f'Не удалось сохранить книгу "{b.get("title")}" из {source}: {e}')
+                    self.forget_source(source)
+                    continue
+                self.books_total += 1
+                if self.dedup:
+                    self.book_index[h] = key
+                    self.new_index[h] = key
+                log.debug('КНИГА #%d  "%s" (%s)  –  %s', self.books_total, b["title"], b["author"], b["location"])
+            else:
+                self.copies_total += 1
+                self.touched_books.add(key)
+                self.new_touched.add(key)
+            self.manifest["books"].setdefault(source, []).append([key, b["location"], b["count"]])
+            self.changed["books"][source] = None
+        self.metrics.times["write"] += time.perf_counter() - start
+
+    def export(self, parts=PARTS):
+        """Сканирует и пишет книги в sink. Воркеры только читают и разбирают,
+        нумерация и запись - здесь, в одном процессе"""
+        self.start()
+        if self.dedup and self.incremental and not self.resumed:
+            self.load_book_index()
+        for source, books, _ in self._sources(parts):
+            self.write_books(books, source)
+        self.remove_stale_books()
+        self.refresh_copies()
+        self.manifest["books_total"] = self.books_total
+
+    def remove_stale_books(self):
+        """Удаляет книги из источников, которые изменились или пропали с прошлого запуска.
+        Книги, которые ещё где-то лежат, остаются, но их copies надо пересобрать"""
+        kept = {s[0] for found in self.manifest["books"].values() for s in found}
+        stale = set()
+        for source, found in self.prev_manifest.get("books", {}).items():
+            if self.manifest["books"].get(source) == found:
+                continue
+            for key, *_ in found:
+                if key in kept:
+                    self.touched_books.add(key)
+                else:
+                    stale.add(key)
+        for key in stale:
+            self.sink.delete(key)
+
+    def books_count(self) -> int:
+        """Сколько книг в выгрузке по манифесту. books_total - последний номер, при
+        инкрементальном скане номера удалённых книг не переиспользуются"""
+        return len({key for found in self.manifest["books"].values() for key, *_ in found})
+
+    def load_book_index(self):
+        """Хеши уже выгруженных книг - чтобы инкрементальный скан не плодил копии"""
+        for key, b in self.sink.items():
+            self.book_index[calculate_book_hash(b)] = key
+
+    def refresh_copies(self):
+        """Пересобирает location/count/copies у книг, чьи находки поменялись за этот скан.
+        Первая находка по порядку манифеста - основная, остальные идут в copies"""
+        if not self.touched_books:
+            return
+        seen = {}
+        for found in self.manifest["books"].values():
+            for key, loc, count in found:
+                if key in self.touched_books:
+                    seen.setdefault(key, []).append((loc, count))
+        for key, found in seen.items():
+            b = self.sink.get(key)
+            (b["location"], b["count"]), rest = found[0], found[1:]
+            if rest:
+                b["copies"] = [{"location": loc, "count": count} for loc, count in rest]
+                b["total_count"] = sum(count for _, count in found)
+            else:
+                b.pop("copies", None)
+                b.pop("total_count", None)
+            self.sink.put(key, b)
+
+    def save_checkpoint(self):
+        """Пишет чекпойнт. Сначала записанное в sink делается надёжным, потом сам чекпойнт -
+        всё, что sink получит после, при продолжении будет убрано. Журнал: первая запись
+        (и первая после resume) - параметры и состояние целиком, дальше в конец дописывается
+        только новое - готовые источники, их строки манифеста, новые хеши. Так запись
+        чекпойнта не растёт с размером мира"""
+        full = not self.checkpoint_started
+        record = {
+            "sink": self.sink.checkpoint(),
+            "counters": {"books_total": self.books_total, "regions_done": self.regions_done,
+                         "chunks_te": self.chunks_te, "chunks_parsed": self.chunks_parsed,
+                         "chunks_skipped": self.chunks_skipped, "chunks_unchanged": self.chunks_unchanged,
+                         "copies_total": self.copies_total},
+            "done": sorted(self.done_sources) if full else self.new_done,
+            "manifest": {section: {key: self.manifest[section].get(key)
+                                   for key in (self.manifest[section] if full else keys)}
+                         for section, keys in self.changed.items()},
+            "book_index": self.book_index if full else self.new_index,
+            "touched_books": sorted(self.touched_books if full else self.new_touched),
+            "metrics": self.metrics.state(None if full else self.new_done),
+        }
+        if full:
+            record = dict(options=self.options(), **record)
+            tmp = self.checkpoint_file.with_suffix(".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+            os.replace(tmp, self.checkpoint_file)
+            self.checkpoint_started = True
+        else:
+            with open(self.checkpoint_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        self.clear_changes()
+        self.last_checkpoint = time.monotonic()
+
+    def clear_changes(self):
+        """Изменения с прошлого чекпойнта учтены (или журнала нет и копить их незачем)"""
+        for keys in self.changed.values():
+            keys.clear()
+        self.new_done = []
+        self.new_index = {}
+        self.new_touched = set()
+
+    def resume(self, state):
+        """Возвращает скан к чекпойнту: счётчики, манифест, индекс дедупликации и sink.
+        Следующий export() продолжит с первого неготового источника"""
+        counters = state["counters"]
+        self.books_total = counters["books_total"]
+        self.regions_done = counters["regions_done"]
+        self.chunks_te = counters["chunks_te"]
+        self.chunks_parsed = counters["chunks_parsed"]
+        self.chunks_skipped = counters["chunks_skipped"]
+        self.chunks_unchanged = counters["chunks_unchanged"]
+        self.copies_total = counters["copies_total"]
+        self.manifest = state["manifest"]
+        self.done_sources.update(state["done"])
+        self.book_index.update(state["book_index"])
+        self.touched_books.update(state["touched_books"])
+        self.metrics.restore(state["metrics"])
+        self.resumed = True
+        # Книги, о которых чекпойнт знает: найденные в этом запуске и (при prev_manifest) прошлые
+        keys = set(self.book_index.values())
+        for books in (self.manifest["books"], self.prev_manifest.get("books", {})):
+            keys.update(key for found in books.values() for key, *_ in found)
+        self.sink.restore(state["sink"], keys)
+
+    def merge(self, shard_paths):
+        """Сливает выгрузки шардов в sink: книги нумеруются заново по порядку источников,
+        одинаковые (если dedup) склеиваются в одну с copies, манифесты объединяются"""
+        self.start()
+        sources = {}
+        for n, path in enumerate(shard_paths):
+            with open(path.with_name(path.name + ".manifest.json"), encoding="utf-8") as f:
+                shard_manifest = json.load(f)
+            self.manifest["regions"].update(shard_manifest.get("regions", {}))
+            self.manifest["files"].update(shard_manifest.get("files", {}))
+            for source, found in shard_manifest.get("books", {}).items():
+                sources[source] = (n, found)
+        shards = [open_sink(path, "r") for path in shard_paths]
+        # (шард, ключ в шарде) -> новый ключ: повторную находку той же книги не надо перечитывать
+        merged = {}
+        for source in sorted(sources, key=source_order):
+            n, found = sources[source]
+            for key, loc, count in found:
+                new_key = merged.get((n, key)) if self.dedup else None
+                if new_key is not None:
+                    self.copies_total += 1
+                    self.touched_books.add(new_key)
+                    self.manifest["books"].setdefault(source, []).append([new_key, loc, count])
+                    continue
+                b = shards[n].get(key)
+                for field in ("copies", "total_count"):
+                    b.pop(field, None)
+                b["location"], b["count"] = loc, count
+                self.write_books([b], source)
+                merged[(n, key)] = self.manifest["books"][source][-1][0]
+        for shard_sink in shards:
+            shard_sink.close()
+        self.refresh_copies()
+        self.manifest["books_total"] = self.books_total
+
 def main():
-    global books_total, regions_done, chunks_te  # Это важно
-    print("Мировой сканер 1.7.10 – старт")
-    world_dirs = find_worlds(WORLD_DIR)
-    if not world_dirs:
-        print("Миры не найдены в", WORLD_DIR)
+    parser = argparse.ArgumentParser(description="Мировой сканер 1.7.10")
+    parser.add_argument("-w", "--world", type=Path, default=WORLD_DIR,
+                        help="папка мира (ищутся все миры и измерения внутри)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="сколько процессов разбирают регионы и игроков (0 = все ядра)")
+    parser.add_argument("--no-prefilter", dest="prefilter", action="store_false",
+                        help="разбирать NBT каждого чанка, даже если в нём нет книг")
+    parser.add_argument("--incremental", action="store_true",
+                        help="перечитать только чанки и файлы, изменившиеся с прошлого запуска")
+    parser.add_argument("-o", "--output", type=Path, default=OUTPUT_DIR / "books_json",
+                        help="куда писать книги: папка, файл .jsonl или .sqlite")
+    parser.add_argument("--no-dedup", dest="dedup", action="store_false",
+                        help="писать каждую копию книги отдельно, как раньше")
+    parser.add_argument("--skip-keys", default=",".join(sorted(SKIP_KEYS)),
+                        help="ключи NBT без предметов, куда обход не спускается, через запятую "
+                             "(пустая строка - обходить всё)")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="писать в консоль каждую найденную книгу (в лог-файл они пишутся всегда)")
+    parser.add_argument("--io-threads", type=int, default=0,
+                        help="конвейер в каждом процессе: поток чтения + столько потоков распаковки, "
+                             "разбор параллельно с ними (0 - без конвейера)")
+    parser.add_argument("--read-ahead", type=int, default=64,
+                        help="сколько прочитанных, но не распакованных чанков держать в очереди")
+    parser.add_argument("--decompress-ahead", type=int, default=0,
+                        help="сколько чанков распаковывать наперёд (0 - по 2 на поток распаковки)")
+    parser.add_argument("--shard", type=parse_shard, metavar="i/N",
+                        help="сканировать только i-ю из N частей мира (для нескольких машин); "
+                             "к имени выгрузки добавляется .siofN")
+    parser.add_argument("--merge", type=Path, nargs="+", metavar="SHARD",
+                        help="не сканировать, а слить выгрузки шардов в -o")
+    parser.add_argument("--box", type=parse_box, action="append", metavar="[DIM:]X1,Z1,X2,Z2",
+                        help="сканировать только эту область в координатах блоков (с точностью до чанка), "
+                             "DIM - измерение (-1 - ад, без него - обычный мир); можно несколько раз")
+    parser.add_argument("--chunk-box", type=partial(parse_box, chunks=True), action="append",
+                        metavar="[DIM:]CX1,CZ1,CX2,CZ2", help="то же в координатах чанков")
+    parser.add_argument("--player", type=player_id, action="append", metavar="UUID",
+                        help="читать файл этого игрока из playerdata; можно несколько раз. "
+                             "С --box/--player сканируется только выбранное, level.dat пропускается")
+    parser.add_argument("--resume", action="store_true",
+                        help="продолжить прерванный скан с последнего чекпойнта (те же параметры, что в прошлый раз)")
+    parser.add_argument("--checkpoint-every", type=float, default=60, metavar="СЕКУНД",
+                        help="как часто писать чекпойнт для --resume (0 - после каждого региона и файла)")
+    args = parser.parse_args()
+    log_queue = setup_logging(args.verbose)
+    skip = frozenset(k for k in args.skip_keys.split(",") if k)
+    shard = args.shard if args.shard and not args.merge else None
+    if shard:
+        # books_json -> books_json.s2of4, books.jsonl -> books.s2of4.jsonl
+        args.output = args.output.with_name(f"{args.output.stem}.s{shard[0]}of{shard[1]}{args.output.suffix}")
+    manifest_file = args.output.with_name(args.output.name + ".manifest.json")
+    checkpoint_file = args.output.with_name(args.output.name + ".checkpoint.jsonl")
+    boxes = players = None
+    if args.box or args.chunk_box:
+        boxes = {}
+        for dim, box in (args.box or []) + (args.chunk_box or []):
+            boxes.setdefault(dim, []).append(box)
+    if args.player:
+        players = set(args.player)
+
+    if args.merge:
+        scanner = Scanner(args.world, open_sink(args.output, "w"), dedup=args.dedup)
+        try:
+            scanner.merge(args.merge)
+        finally:
+            scanner.sink.close()
+        save_manifest(scanner.manifest, manifest_file)
+        print(f"Шардов слито: {len(args.merge)}")
+        print(f"Всего книг: {scanner.books_total}")
+        if scanner.copies_total:
+            print(f"Повторных копий (записаны в copies, а не отдельно): {scanner.copies_total}")
+        print("Книги сохранены в:", args.output)
         return
-    for world_dir in world_dirs:
-        log.info(f"Сканирую мир: {world_dir}")
-        scan_level_dat(world_dir)
-        scan_players(world_dir)
-        scan_world_regions(world_dir)
+    jobs = args.jobs or os.cpu_count() or 1
+    pipeline = None
+    if args.io_threads > 0:
+        pipeline = (args.io_threads, max(1, args.read_ahead), args.decompress_ahead or 2 * args.io_threads)
+    scanner = Scanner(args.world, prefilter=args.prefilter, skip=skip, pipeline=pipeline, dedup=args.dedup,
+                      shard=shard, boxes=boxes, players=players,
+                      prev_manifest=load_manifest(manifest_file) if args.incremental else None,
+                      checkpoint_file=checkpoint_file, checkpoint_every=args.checkpoint_every)
+    checkpoint = None
+    if args.resume:
+        checkpoint = load_checkpoint(checkpoint_file)
+        if checkpoint is None:
+            print("Нечего продолжать: нет чекпойнта", checkpoint_file)
+            return
+        if checkpoint["options"] != scanner.options():
+            differ = {k: v for k, v in checkpoint["options"].items() if scanner.options().get(k) != v}
+            print("Чекпойнт", checkpoint_file, "записан с другими параметрами:", differ)
+            return
+
+    print("Мировой сканер 1.7.10 – старт" + (f", часть {shard[0]} из {shard[1]}" if shard else ""))
+    if scanner.filtered():
+        print(f"Фильтр: областей {sum(len(b) for b in (boxes or {}).values())}, игроков {len(players or ())}")
+    if not scanner.worlds():
+        print("Миры не найдены в", args.world)
+        return
+    scanner.sink = open_sink(args.output, "a" if args.incremental or checkpoint else "w")
+    if checkpoint:
+        scanner.resume(checkpoint)
+        print(f"Продолжаю с чекпойнта: источников готово {len(scanner.done_sources)}, книг {scanner.books_total}")
+    if jobs > 1:
+        scanner.pool = multiprocessing.Pool(jobs, init_worker, (log_queue,))
+    try:
+        scanner.export()
+    finally:
+        if scanner.pool is not None:
+            scanner.pool.close()
+            scanner.pool.join()
+        scanner.sink.close()
+    save_manifest(scanner.manifest, manifest_file)
+    checkpoint_file.unlink(missing_ok=True)
+    metrics_file = args.output.with_name(args.output.name + ".metrics.json")
+    scanner.metrics.save(metrics_file, books_total=scanner.books_total, copies_total=scanner.copies_total,
+                         regions_done=scanner.regions_done, chunks_te=scanner.chunks_te,
+                         chunks_parsed=scanner.chunks_parsed, chunks_skipped=scanner.chunks_skipped,
+                         chunks_unchanged=scanner.chunks_unchanged, jobs=jobs)
     print("Готово!")
-    print(f"Регионов обработано: {regions_done}")
-    print(f"Чанков с контейнерами: {chunks_te}")
-    print(f"Всего найдено written_book: {books_total}")
-    if books_total:
-        print("Файлы сохранены в:", OUTPUT_DIR / "books_json")
+    print(f"Регионов обработано: {scanner.regions_done}")
+    print(f"Чанков с контейнерами: {scanner.chunks_te}")
+    print(f"Чанков разобрано: {scanner.chunks_parsed}, пропущено фильтром: {scanner.chunks_skipped}")
+    if args.incremental:
+        print(f"Чанков без изменений: {scanner.chunks_unchanged}")
+    books = scanner.books_count()
+    print(f"Всего найдено written_book: {books}")
+    if args.incremental:
+        print(f"Последний номер книги: {scanner.books_total}")
+    if scanner.copies_total:
+        print(f"Повторных копий (записаны в copies, а не отдельно): {scanner.copies_total}")
+    if books:
+        print("Книги сохранены в:", args.output)
+    print("Время по фазам:", ", ".join(f"{phase} {t:.1f} с" for phase, t in scanner.metrics.times.items()))
+    print("Замеры скана:", metrics_file)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -6,78 +6,92 @@
 import os
 import json
 import hashlib
+import argparse
+import multiprocessing
+import re
+from collections import deque
+from functools import lru_cache, partial
+from itertools import islice
 from pathlib import Path
+from sinks import PageSink, open_sink
+import neardup
+
+# Смешанная кодировка: в одной строке нормальная кириллица и куски, набранные через
+# русификатор - cp1251-байты, прочитанные как latin1 ("Ð¿Ñ€Ð¸"). Всё ниже - таблицы и
+# скомпилированные регулярки, чтобы не гонять строки по символу в питоне.
+_CYRILLIC = re.compile('[А-я]')
+# Типичные символы cp1251 в UTF-8 тексте
+_CP1251_INDICATORS = re.compile('[ÑÐÎÂàáâãäåæçèéêë]')
+# Куски строки, которые не кириллица - именно их и перекодируем
+_NOT_CYRILLIC_RUNS = re.compile('[^А-яЁё]+')
+
+# latin1 -> cp1251 посимвольно: U+00XX это байт XX, cp1251 читает его как свою букву.
+# Байт 0x98 в cp1251 не определён, символы выше U+00FF в latin1 не кодируются -
+# кусок с такими символами остаётся как есть, ровно как при encode/decode
+_LATIN1_TO_CP1251 = {}
+for _b in range(256):
+    try:
+        _LATIN1_TO_CP1251[_b] = bytes([_b]).decode('cp1251')
+    except UnicodeDecodeError:
+        pass
+_NOT_RECODABLE = re.compile('[^%s]' % ''.join(re.escape(chr(b)) for b in _LATIN1_TO_CP1251))
+# То же, но кириллица не мешает: её в таблице нет, translate её и так не тронет
+_NOT_RECODABLE_MIXED = re.compile('[^%sА-яЁё]' % ''.join(re.escape(chr(b)) for b in _LATIN1_TO_CP1251))
+
+# Кеш для коротких строк, которые часто повторяются (авторы, названия, одинаковые страницы)
+MEMO_SIZE = 8192
+MEMO_MAX_LEN = 1024
+
+# Книги из папки с JSON больше стольких байт чинятся потоково, по странице (stream_repair_book):
+# модовые книги на десятки тысяч страниц иначе занимают в памяти в разы больше файла
+STREAM_OVER = 8 << 20
+STREAM_BLOCK = 1 << 20
+_WHITESPACE = re.compile('[ \t\n\r]*')
+_json_decoder = json.JSONDecoder()
+
+def _recode(text):
+    """text.encode('latin1').decode('cp1251'), а при ошибке - text без изменений"""
+    if _NOT_RECODABLE.search(text):
+        return text
+    return text.translate(_LATIN1_TO_CP1251)
+
+def _recode_run(match):
+    return _recode(match.group())
+
+def _recode_mixed(text):
+    # Обычно перекодируются все куски - тогда хватит одного translate на всю строку,
+    # иначе идём по кускам и не трогаем те, где есть неперекодируемые символы
+    if not _NOT_RECODABLE_MIXED.search(text):
+        return text.translate(_LATIN1_TO_CP1251)
+    return _NOT_CYRILLIC_RUNS.sub(_recode_run, text)
 
 def is_mixed_encoding(text):
     """Определяет, есть ли в тексте смешанная кодировка"""
-    # Проверяем наличие типичных символов cp1251 в UTF-8 тексте
-    cp1251_indicators = ['Ñ', 'Ð', 'Î', 'Â', 'à', 'á', 'â', 'ã', 'ä', 'å', 'æ', 'ç', 'è', 'é', 'ê', 'ë']
-    utf8_cyrillic = any('А' <= c <= 'я' for c in text)
-    cp1251_chars = any(indicator in text for indicator in cp1251_indicators)
-    
-    return utf8_cyrillic and cp1251_chars
+    return bool(_CYRILLIC.search(text) and _CP1251_INDICATORS.search(text))
 
 def fix_mixed_encoding(text):
     """Исправляет смешанную кодировку в тексте"""
     if not is_mixed_encoding(text):
         return text
-    
-    try:
-        # Разбиваем текст на части и обрабатываем каждую часть отдельно
-        result = []
-        current_part = []
-        current_encoding = None
-        
-        for char in text:
-            # Определяем кодировку текущего символа
-            char_encoding = 'utf8' if ('А' <= char <= 'я' or char in 'Ёё') else 'cp1251'
-            
-            if current_encoding is None:
-                current_encoding = char_encoding
-                current_part.append(char)
-            elif current_encoding == char_encoding:
-                current_part.append(char)
-            else:
-                # Смена кодировки - обрабатываем накопленную часть
-                part_text = ''.join(current_part)
-                if current_encoding == 'cp1251':
-                    try:
-                        part_text = part_text.encode('latin1').decode('cp1251')
-                    except:
-                        pass
-                result.append(part_text)
-                
-                # Начинаем новую часть
-                current_part = [char]
-                current_encoding = char_encoding
-        
-        # Обрабатываем последнюю часть
-        if current_part:
-            part_text = ''.join(current_part)
-            if current_encoding == 'cp1251':
-                try:
-                    part_text = part_text.encode('latin1').decode('cp1251')
-                except:
-                    pass
-            result.append(part_text)
-        
-        return ''.join(result)
-        
-    except Exception as e:
-        print(f"Ошибка при исправлении смешанной кодировки: {e}")
-        return text
+    # Кириллицу оставляем, всё между ней перекодируем
+    return _recode_mixed(text)
+
+def _repair(text):
+    if is_mixed_encoding(text):
+        return _recode_mixed(text), True
+    return _recode(text), False
+
+_repair_cached = lru_cache(maxsize=MEMO_SIZE)(_repair)
+
+def repair_text(text):
+    """Исправляет кодировку и говорит, была ли она смешанной - за один разбор строки"""
+    if len(text) <= MEMO_MAX_LEN:
+        return _repair_cached(text)
+    return _repair(text)
 
 def fix_encoding(text):
     """Исправляет кодировку текста (назовём u-mode)"""
-    # Сначала проверяем на смешанную кодировку
-    if is_mixed_encoding(text):
-        return fix_mixed_encoding(text)
-    
-    # Пробуем стандартное исправление cp1251
-    try:
-        return text.encode('latin1').decode('cp1251')
-    except:
-        return text
+    return repair_text(text)[0]
 
 def fix_filename(filename):
     """Исправляет кодировку в имени файла"""
@@ -103,107 +117,292 @@ def calculate_book_hash(book_data):
     content_string = '|'.join(content_parts)
     return hashlib.md5(content_string.encode('utf-8')).hexdigest()
 
-def process_json_file(input_path, output_dir):
-    """Обрабатывает один JSON файл и возвращает информацию о книге"""
+class BookHash:
+    """calculate_book_hash по кускам: title, author, потом страницы по одной"""
+
+    def __init__(self):
+        self.md5 = hashlib.md5()
+        self.parts = 0
+
+    def add(self, text):
+        if self.parts:
+            self.md5.update(b'|')
+        self.md5.update(text.encode('utf-8'))
+        self.parts += 1
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+def fix_encoding_recursive(obj):
+    """Исправляет кодировку во всех строках JSON-значения"""
+    if isinstance(obj, dict):
+        return {key: fix_encoding_recursive(value) for key, value in obj.items()}
+    elif isinstance(obj, list):
+        return [fix_encoding_recursive(item) for item in obj]
+    elif isinstance(obj, str):
+        fixed_text, mixed = repair_text(obj)
+        # Логируем исправления для отладки
+        if mixed and fixed_text != obj:
+            print(f"  Исправлена смешанная кодировка в тексте длиной {len(obj)} символов")
+        return fixed_text
+    else:
+        return obj
+
+def book_base_name(name, fixed_data):
+    """Имя для исправленной книги (без номера): по исправленному title или по старому имени"""
+    if 'title' in fixed_data and fixed_data['title']:
+        # Создаем новое имя файла на основе заголовка
+        title = fixed_data['title']
+        # Заменяем недопустимые символы в имени файла
+        safe_title = "".join(c if c.isalnum() or c in (' ', '-', '_') else '_' for c in title)
+        safe_title = safe_title.strip().replace(' ', '_')[:50]  # Ограничиваем длину
+        return f"book_{safe_title}"
+    # Если заголовка нет, исправляем кодировку исходного имени
+    return Path(fix_filename(f"{name}.json")).stem
+
+class JsonStream:
+    """JSON из файла по кусочку: буфер догружается блоками, каждое значение разбирает
+    обычный json (raw_decode). Массив и объект можно пройти по элементам, не читая целиком"""
+
+    def __init__(self, f, block=STREAM_BLOCK):
+        self.f = f
+        self.block = block
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _more(self):
+        # Если значение не влезло, буфер растёт вдвое - огромная страница не будет
+        # разбираться заново на каждый новый блок
+        chunk = self.f.read(max(self.block, len(self.buf) - self.pos))
+        self.eof = not chunk
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        """Следующий значащий символ, '' в конце файла"""
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self._more()
+
+    def _expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f"ожидался {' или '.join(chars)}, а не {char!r}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Следующее значение целиком"""
+        while True:
+            self.peek()
+            try:
+                value, end = _json_decoder.raw_decode(self.buf, self.pos)
+                # Число в конце буфера могло оборваться на границе блока: "1." или "12e" json
+                # разберёт как 1 и 12 - такое принимаем, только если дальше точно не его продолжение
+                cut = isinstance(value, (int, float)) and not isinstance(value, bool) \
+                    and (end == len(self.buf) or self.buf[end] in '.eE+-')
+                if not cut or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._more()
+
+    def array(self):
+        """Элементы массива по одному"""
+        self._expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self._expect(',]') == ']':
+                return
+
+    def keys(self):
+        """Ключи объекта по одному. Значение после каждого ключа читает вызывающий - value() или array()"""
+        self._expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self._expect(':')
+            yield key
+            if self._expect(',}') == '}':
+                return
+
+def _hashed_fields(fields):
+    return [key for key in ('title', 'author') if key in fields]
+
+def _rehash(path, fields):
+    """calculate_book_hash по уже записанной книге - когда title/author стоят после pages"""
+    book_hash = BookHash()
+    for key in _hashed_fields(fields):
+        book_hash.add(fields[key])
+    with open(path, encoding='utf-8') as f:
+        stream = JsonStream(f)
+        for key in stream.keys():
+            if key == 'pages':
+                for page in stream.array():
+                    book_hash.add(page)
+            else:
+                stream.value()
+    return book_hash.hexdigest()
+
+def stream_repair_book(name, path, tmp_dir, near=False):
+    """repair_book для огромной книги в файле path: страницы по одной читаются, чинятся
+    и дописываются компактным JSON во временный файл в tmp_dir, хеш и подпись считаются
+    по ходу. Память не зависит от размера книги. Вместо 'data' в ответе 'file'"""
+    # Не .json - чтобы папка-хранилище не приняла недописанный файл за книгу
+    tmp = Path(tmp_dir) / f".{name}.{os.getpid()}.part"
     try:
-        # Читаем исходный файл
-        with open(input_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        # Парсим JSON
-        data = json.loads(content)
-        
-        # Рекурсивно исправляем кодировку
-        def fix_encoding_recursive(obj):
-            if isinstance(obj, dict):
-                return {key: fix_encoding_recursive(value) for key, value in obj.items()}
-            elif isinstance(obj, list):
-                return [fix_encoding_recursive(item) for item in obj]
-            elif isinstance(obj, str):
-                fixed_text = fix_encoding(obj)
-                # Логируем исправления для отладки
-                if fixed_text != obj and is_mixed_encoding(obj):
-                    print(f"  Исправлена смешанная кодировка в тексте длиной {len(obj)} символов")
-                return fixed_text
+        # Всё, кроме страниц (title, author, location...) - оно маленькое, держим целиком
+        fields = {}
+        book_hash = BookHash()
+        hashed_with = None
+        minhash = neardup.MinHasher() if near else None
+        size = 0
+        with open(path, encoding='utf-8') as src, open(tmp, 'w', encoding='utf-8') as dst:
+            stream = JsonStream(src)
+            dst.write('{')
+            for i, key in enumerate(stream.keys()):
+                dst.write((', ' if i else '') + json.dumps(key, ensure_ascii=False) + ': ')
+                if key == 'pages' and hashed_with is None and stream.peek() == '[':
+                    hashed_with = _hashed_fields(fields)
+                    for field in hashed_with:
+                        book_hash.add(fields[field])
+                    dst.write('[')
+                    for n, page in enumerate(stream.array()):
+                        page = fix_encoding_recursive(page)
+                        dst.write((', ' if n else '') + json.dumps(page, ensure_ascii=False))
+                        book_hash.add(page)
+                        if minhash is not None:
+                            minhash.update(page)
+                            size += len(page)
+                    dst.write(']')
+                else:
+                    fields[key] = fix_encoding_recursive(stream.value())
+                    dst.write(json.dumps(fields[key], ensure_ascii=False))
+            dst.write('}')
+        if hashed_with is None:
+            digest = calculate_book_hash(fields)
+        elif hashed_with != _hashed_fields(fields):
+            digest = _rehash(tmp, fields)
+        else:
+            digest = book_hash.hexdigest()
+        info = {
+            'original_name': name,
+            'base_name': book_base_name(name, fields),
+            'file': tmp,
+            'hash': digest,
+            'title': fields.get('title'),
+            'author': fields.get('author', '')
+        }
+        if near:
+            if hashed_with is None:
+                pages = fields.get('pages', [])
+                info['minhash'] = neardup.signature(pages)
+                info['size'] = sum(len(p) for p in pages)
             else:
-                return obj
-        
+                info['minhash'] = minhash.signature()
+                info['size'] = size
+        return info
+    except Exception as e:
+        print(f"Ошибка в {name}: {e}")
+        tmp.unlink(missing_ok=True)
+        return None
+
+def repair_book(item, near=False, tmp_dir=None):
+    """Исправляет одну книгу, item - (её ключ во входном хранилище, данные).
+    Ничего не пишет и не хранит - выполняется в воркере. Возвращает информацию о книге.
+    near - посчитать ещё и MinHash-подпись страниц для поиска почти-дублей.
+    Если вместо данных путь к файлу - книга огромная, чинится потоково в tmp_dir"""
+    name, data = item
+    if isinstance(data, Path):
+        return stream_repair_book(name, data, tmp_dir, near)
+    try:
+        # Рекурсивно исправляем кодировку
         fixed_data = fix_encoding_recursive(data)
         
-        # Исправляем имя файла на основе исправленного title
-        original_filename = input_path.name
-        if 'title' in fixed_data and fixed_data['title']:
-            # Создаем новое имя файла на основе заголовка
-            title = fixed_data['title']
-            # Заменяем недопустимые символы в имени файла
-            safe_title = "".join(c if c.isalnum() or c in (' ', '-', '_') else '_' for c in title)
-            safe_title = safe_title.strip().replace(' ', '_')[:50]  # Ограничиваем длину
-            new_filename = f"book_{safe_title}.json"
-        else:
-            # Если заголовка нет, исправляем кодировку исходного имени
-            new_filename = fix_filename(original_filename)
-        
-        # Создаем полный путь для выходного файла
-        output_path = Path(output_dir) / new_filename
-        
-        # Если файл с таким именем уже существует, добавляем номер
-        counter = 1
-        original_output_path = output_path
-        while output_path.exists():
-            name, ext = os.path.splitext(original_output_path.name)
-            output_path = Path(output_dir) / f"{name}_{counter:02d}{ext}"
-            counter += 1
-        
-        # Сохраняем исправленный файл
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(fixed_data, f, ensure_ascii=False, indent=2, separators=(',', ': '))
-        
-        # Возвращаем информацию о книге для дедупликации
-        book_info = {
-            'original_path': input_path,
-            'new_path': output_path,
+        info = {
+            'original_name': name,
+            'base_name': book_base_name(name, fixed_data),
             'data': fixed_data,
             'hash': calculate_book_hash(fixed_data),
-            'title': fixed_data.get('title', ''),
             'author': fixed_data.get('author', '')
         }
-        
-        print(f"Исправлен: {original_filename} -> {output_path.name}")
-        return book_info
+        if near:
+            pages = fixed_data.get('pages', [])
+            info['minhash'] = neardup.signature(pages)
+            info['size'] = sum(len(p) for p in pages)
+        return info
         
     except Exception as e:
-        print(f"Ошибка в {input_path.name}: {e}")
+        print(f"Ошибка в {name}: {e}")
         return None
 
-def remove_duplicate_books(books_info):
-    """Удаляет дубликаты книг и возвращает список уникальных"""
-    seen_hashes = set()
-    unique_books = []
-    duplicates = []
-    
-    for book in books_info:
-        if book and book['hash'] not in seen_hashes:
-            seen_hashes.add(book['hash'])
-            unique_books.append(book)
-        elif book:
-            duplicates.append(book)
-    
-    return unique_books, duplicates
+def choose_name(base, taken, counters):
+    """Свободное имя книги без опроса диска: base, base_01, base_02...
+    taken - уже занятые имена, counters - с какого номера продолжать для base"""
+    n = counters.get(base, 0)
+    name = base if n == 0 else f"{base}_{n:02d}"
+    while name in taken:
+        n += 1
+        name = f"{base}_{n:02d}"
+    counters[base] = n + 1
+    taken.add(name)
+    return name
+
+def windowed_imap(func, items, pool, window):
+    """Как pool.imap, но в пуле не больше window заданий сразу: готовое забрали - отдаём следующее.
+    Иначе imap вычитает весь вход в память, а результаты скопятся, если потребитель медленнее
+    воркеров. Окно скользящее - процессы не простаивают, пока разбирается пачка. Общее с book.py"""
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
 
-def analyze_encoding_problems(input_dir):
-    """Анализирует файлы на наличие проблем с кодировкой"""
+def repaired_books(items, pool=None, window=256, worker=repair_book):
+    """Исправленные книги по порядку. В пуле не больше window книг сразу"""
+    if pool is None:
+        yield from map(worker, items)
+        return
+    yield from windowed_imap(worker, items, pool, window)
+
+def unique_records(source, duplicates):
+    """Книги из хранилища страниц (PageSink) без повторов: у одинаковых книг одинаковые записи -
+    те же title, author и хеши страниц, так что calculate_book_hash по записи их и находит,
+    не читая и не исправляя страниц. duplicates - {ключ повтора: ключ первой такой книги}"""
+    first = {}
+    for name, record in source.records():
+        record_hash = calculate_book_hash(record)
+        original = first.get(record_hash)
+        if original is not None:
+            duplicates[name] = original
+            print(f"Дубликат: {name} = {original} (одинаковые записи во входном хранилище)")
+            continue
+        first[record_hash] = name
+        yield name, source.rebuild(record)
+
+def analyze_encoding_problems(source, stream_over=None):
+    """Анализирует книги на наличие проблем с кодировкой"""
     print("Анализ проблем с кодировкой...")
-    json_files = list(Path(input_dir).glob("*.json"))
     
     mixed_encoding_count = 0
-    total_files = len(json_files)
     
-    for file_path in json_files[:5]:  # Проверяем первые 5 файлов для примера
+    for name, data in islice(source.items(stream_over), 5):  # Проверяем первые 5 книг для примера
+        if isinstance(data, Path):
+            # Огромную книгу ради примера целиком не читаем
+            continue
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            data = json.loads(content)
-            
             # Проверяем поля на смешанную кодировку
             def check_mixed(obj, path=""):
                 if isinstance(obj, dict):
@@ -215,7 +414,7 @@ def analyze_encoding_problems(input_dir):
                 elif isinstance(obj, str) and is_mixed_encoding(obj):
                     nonlocal mixed_encoding_count
                     mixed_encoding_count += 1
-                    print(f" Найден файл со смешанной кодировкой: {file_path.name}")
+                    print(f" Найден файл со смешанной кодировкой: {name}")
                     return
             
             check_mixed(data)
@@ -228,66 +427,125 @@ def analyze_encoding_problems(input_dir):
     else:
         print("Файлов со смешанной кодировкой не обнаружено")
 
+def near_duplicates_report(index, out, report_file):
+    """Пишет кластеры почти одинаковых книг: главная книга и остальные с похожестью на неё"""
+    clusters = []
+    for main_name, others in sorted(index.clusters(), key=lambda c: -len(c[1])):
+        def describe(name, similarity=None):
+            book = out.get(name)
+            entry = {'name': name, 'title': book.get('title'), 'author': book.get('author')}
+            if similarity is not None:
+                entry['similarity'] = similarity
+            return entry
+        clusters.append({'canonical': describe(main_name),
+                         'others': [describe(name, sim) for name, sim in others]})
+    with open(report_file, 'w', encoding='utf-8') as f:
+        json.dump({'threshold': index.threshold, 'books': len(index), 'clusters': clusters},
+                  f, ensure_ascii=False, indent=2)
+    return clusters
+
 def main():
-    input_dir = "exported_books/books_json"
-    output_dir = "exported_books/books_fixed"
+    # Вход и выход - папка, .jsonl или .sqlite (см. sinks.py)
+    parser = argparse.ArgumentParser(description="Фикс кодировки и удаление дублей")
+    parser.add_argument("-i", "--input", default="exported_books/books_json")
+    parser.add_argument("-o", "--output", default="exported_books/books_fixed")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="сколько процессов исправляют книги (0 = все ядра)")
+    parser.add_argument("--near-dups", type=float, nargs="?", const=0.8, metavar="ПОРОГ",
+                        help="искать почти одинаковые книги (похожесть страниц от ПОРОГ, по умолчанию 0.8) "
+                             "и записать отчёт рядом с выходом")
+    parser.add_argument("--stream-over", type=float, default=STREAM_OVER / (1 << 20), metavar="МИБ",
+                        help="книги из папки больше стольких МиБ чинить потоково, по странице, "
+                             "и писать компактным JSON (по умолчанию %(default)g)")
+    args = parser.parse_args()
+    jobs = args.jobs or os.cpu_count() or 1
+    stream_over = int(args.stream_over * (1 << 20))
+    input_dir = args.input
+    output_dir = args.output
     
     if not os.path.exists(input_dir):
         print(f"Исходная директория {input_dir} не найдена!")
         return
     
-    # Анализируем проблемы с кодировкой
-    analyze_encoding_problems(input_dir)
-    
-    # Создаем выходную директорию
-    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    source = open_sink(input_dir, "r")
     
-    # Находим все JSON файлы
-    json_files = list(Path(input_dir).glob("*.json"))
+    # Анализируем проблемы с кодировкой
+    analyze_encoding_problems(source, stream_over)
     
-    if not json_files:
-        print("JSON файлы не найдены!")
-        return
+    # Создаем выходное хранилище
+    out = open_sink(output_dir, "a", indent=2)
     
-    print(f"\nНайдено {len(json_files)} файлов для обработки...")
-    print(f"Исходная папка: {input_dir}")
+    print(f"\nИсходная папка: {input_dir}")
     print(f"Выходная папка: {output_dir}")
     print("-" * 50)
     
-    # Обрабатываем все файлы и собираем информацию
-    all_books_info = []
-    for input_path in json_files:
-        book_info = process_json_file(input_path, output_dir)
-        all_books_info.append(book_info)
-    
-    # Удаляем None (файлы с ошибками)
-    successful_books = [book for book in all_books_info if book is not None]
-    
-    # Удаляем дубликаты
-    unique_books, duplicates = remove_duplicate_books(successful_books)
+    # В памяти только хеши и выбранные имена - сами книги сразу уходят в out.
+    # Дубликаты не пишутся вовсе, а не удаляются потом
+    taken = set(out.keys())
+    counters = {}
+    seen_hashes = {}
+    total = successful = duplicates = 0
+    near = neardup.NearDupIndex(args.near_dups) if args.near_dups else None
+    near_clusters = None
+    # Временные файлы потоковой починки - рядом с выходом, чтобы в папку их можно было переименовать
+    tmp_dir = out.path if out.path.is_dir() else out.path.parent
+    worker = partial(repair_book, near=near is not None, tmp_dir=tmp_dir)
+    # Повторы из хранилища страниц отсеиваются ещё до починки
+    record_duplicates = {}
+    if isinstance(source, PageSink):
+        items = unique_records(source, record_duplicates)
+    else:
+        items = iter(source.items(stream_over))
+    pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+    try:
+        for book_info in repaired_books(items, pool, jobs * 64, worker):
+            total += 1
+            if book_info is None:
+                continue
+            successful += 1
+            original = seen_hashes.get(book_info['hash'])
+            if original is not None:
+                duplicates += 1
+                print(f"Дубликат: {book_info['original_name']} = {original} (автор: {book_info['author']})")
+                if 'file' in book_info:
+                    os.remove(book_info['file'])
+                continue
+            output_name = choose_name(book_info['base_name'], taken, counters)
+            if 'file' in book_info:
+                out.put_file(output_name, book_info['file'], book_info['title'], book_info['author'] or None)
+            else:
+                out.put(output_name, book_info['data'])
+            seen_hashes[book_info['hash']] = output_name
+            print(f"Исправлен: {book_info['original_name']} -> {output_name}")
+            if near is not None and book_info['minhash'] is not None:
+                near.add(output_name, book_info['minhash'], book_info['size'])
+        if near is not None:
+            report_file = Path(output_dir).with_name(Path(output_dir).name + ".near_duplicates.json")
+            near_clusters = near_duplicates_report(near, out, report_file)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        out.close()
+    total += len(record_duplicates)
+    successful += len(record_duplicates)
+    duplicates += len(record_duplicates)
     
-    # Удаляем файлы-дубликаты
-    for duplicate in duplicates:
-        try:
-            os.remove(duplicate['new_path'])
-            print(f"Удален дубликат: {duplicate['new_path'].name}")
-        except Exception as e:
-            print(f"Не удалось удалить дубликат {duplicate['new_path'].name}: {e}")
+    if not total:
+        print("JSON файлы не найдены!")
+        return
     
     print("-" * 50)
     print("СТАТИСТИКА:")
-    print(f"Всего обработано файлов: {len(json_files)}")
-    print(f"Успешно обработано: {len(successful_books)}")
-    print(f"Найдено дубликатов: {len(duplicates)}")
-    print(f"Уникальных книг: {len(unique_books)}")
-    print(f"Ошибок обработки: {len(all_books_info) - len(successful_books)}")
+    print(f"Всего обработано файлов: {total + source.errors}")
+    print(f"Успешно обработано: {successful}")
+    print(f"Найдено дубликатов: {duplicates}")
+    print(f"Уникальных книг: {len(seen_hashes)}")
+    if near_clusters is not None:
+        print(f"Групп почти одинаковых книг: {len(near_clusters)} "
+              f"(книг в них: {sum(len(c['others']) + 1 for c in near_clusters)}), отчёт: {report_file}")
+    print(f"Ошибок обработки: {total - successful + source.errors}")
     print(f"Исправленные файлы сохранены в: {output_dir}")
-    
-    # Выводим информацию о дубликатах
-    if duplicates:
-        print("\nУДАЛЕННЫЕ ДУБЛИКАТЫ:")
-        for dup in duplicates:
-            print(f"  - {dup['new_path'].name} (автор: {dup['author']})")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
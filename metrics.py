@@ -0,0 +1,136 @@
+# Замеры скана: время по фазам, счётчики по регионам, прогресс с оценкой оставшегося времени.
+# Воркеры меряют свою часть через Stopwatch и отдают времена вместе с результатом,
+# главный процесс складывает всё в Metrics и в конце пишет metrics.json.
+# Время фаз - сумма по всем процессам, при --jobs N оно больше времени по часам.
+
+import json, time
+from datetime import datetime
+
+# wait - разбор простаивает, ожидая чтения и распаковки (только в конвейере, --io-threads)
+PHASES = ("read", "decompress", "parse", "walk", "write", "wait")
+
+class Stopwatch:
+    """Раскладывает время по фазам: lap(фаза) приписывает ей всё, что прошло с прошлого lap"""
+
+    def __init__(self):
+        self.times = dict.fromkeys(PHASES, 0.0)
+        self._last = time.perf_counter()
+
+    def reset(self):
+        """Время с прошлого lap не относится ни к одной фазе"""
+        self._last = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.times[phase] += now - self._last
+        self._last = now
+
+def format_duration(seconds) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+def format_size(n) -> str:
+    for unit in ("Б", "КиБ", "МиБ"):
+        if n < 1024:
+            return f"{n:.0f} {unit}" if unit == "Б" else f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} ГиБ"
+
+class Metrics:
+    """Всё, что насчитал скан. Прогресс и ETA - по байтам регионов: чанки разного размера,
+    а байты читаются с диска примерно с одной скоростью"""
+
+    def __init__(self):
+        self.started = datetime.now()
+        self._start = time.perf_counter()
+        self.times = dict.fromkeys(PHASES, 0.0)
+        self.regions = {}
+        self.players = {"files": 0, "bytes": 0, "books": 0}
+        self.total_regions = 0
+        self.total_bytes = 0
+        self.done_bytes = 0
+        self.chunks = 0
+        # Сколько было сделано до --resume - скорость считается только по этому запуску
+        self._resumed_bytes = 0
+        self._resumed_chunks = 0
+
+    def add_times(self, times):
+        for phase, t in times.items():
+            self.times[phase] += t
+
+    def plan(self, region_files):
+        """Запоминает, сколько регионов и байт предстоит прочитать"""
+        self._start = time.perf_counter()
+        for rfile in region_files:
+            self.total_regions += 1
+            self.total_bytes += rfile.stat().st_size
+
+    def player_done(self, size, books, times):
+        self.add_times(times)
+        self.players["files"] += 1
+        self.players["bytes"] += size
+        self.players["books"] += books
+
+    def region_done(self, rel, size, stats, books):
+        self.add_times(stats["times"])
+        self.done_bytes += size
+        self.chunks += stats["chunks"]
+        self.regions[rel] = {
+            "bytes": size,
+            "chunks": stats["chunks"],
+            "read_bytes": stats["read_bytes"],
+            "raw_bytes": stats["raw_bytes"],
+            "books": books,
+            "seconds": round(sum(stats["times"].values()), 3),
+        }
+
+    def state(self, regions=None) -> dict:
+        """Всё насчитанное - для чекпойнта. regions - только эти регионы (None - все)"""
+        if regions is not None:
+            regions = {rel: self.regions[rel] for rel in regions if rel in self.regions}
+        return {"times": self.times, "regions": self.regions if regions is None else regions,
+                "players": self.players, "done_bytes": self.done_bytes, "chunks": self.chunks}
+
+    def restore(self, state):
+        """Продолжение с чекпойнта (--resume)"""
+        self.times.update(state["times"])
+        self.regions.update(state["regions"])
+        self.players.update(state["players"])
+        self.done_bytes = self._resumed_bytes = state["done_bytes"]
+        self.chunks = self._resumed_chunks = state["chunks"]
+
+    def progress(self) -> str:
+        """Строка прогресса: сколько прочитано, скорость, сколько осталось"""
+        elapsed = time.perf_counter() - self._start
+        line = f"{len(self.regions)}/{self.total_regions} регионов, " \
+               f"{format_size(self.done_bytes)} из {format_size(self.total_bytes)}"
+        if self.total_bytes:
+            line += f" ({self.done_bytes / self.total_bytes:.0%})"
+        if elapsed > 0:
+            line += f", {(self.chunks - self._resumed_chunks) / elapsed:.0f} чанков/с"
+        done = self.done_bytes - self._resumed_bytes
+        if done and self.total_bytes > self.done_bytes:
+            left = elapsed * (self.total_bytes - self.done_bytes) / done
+            line += f", осталось ~{format_duration(left)}"
+        return line
+
+    def save(self, path, **counters):
+        """Пишет metrics.json, counters - итоговые счётчики сканера"""
+        seconds = time.perf_counter() - self._start
+        data = {
+            "started": self.started.isoformat(timespec="seconds"),
+            "seconds": round(seconds, 3),
+            "phases": {phase: round(t, 3) for phase, t in self.times.items()},
+            "counters": counters,
+            "bytes": {
+                "regions": self.done_bytes,
+                "chunks_read": sum(r["read_bytes"] for r in self.regions.values()),
+                "chunks_raw": sum(r["raw_bytes"] for r in self.regions.values()),
+                "players": self.players["bytes"],
+            },
+            "players": self.players,
+            "regions": self.regions,
+        }
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=1)
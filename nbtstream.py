@@ -0,0 +1,138 @@
+# Свой читатель NBT без сторонних либ.
+# Идёт по байтам и строит объекты только для нужных веток дерева, остальное
+# (Blocks, Data, SkyLight, HeightMap, секции...) перепрыгивает по длинам, ничего не создавая.
+
+import struct
+
+TAG_END, TAG_BYTE, TAG_SHORT, TAG_INT, TAG_LONG, TAG_FLOAT, TAG_DOUBLE, \
+    TAG_BYTE_ARRAY, TAG_STRING, TAG_LIST, TAG_COMPOUND, TAG_INT_ARRAY, TAG_LONG_ARRAY = range(13)
+
+_U16 = struct.Struct(">H")
+_I32 = struct.Struct(">i")
+# Числовые теги: как читать и сколько байт занимают
+_NUMBERS = {
+    TAG_BYTE: struct.Struct(">b"),
+    TAG_SHORT: struct.Struct(">h"),
+    TAG_INT: _I32,
+    TAG_LONG: struct.Struct(">q"),
+    TAG_FLOAT: struct.Struct(">f"),
+    TAG_DOUBLE: struct.Struct(">d"),
+}
+_SIZES = {t: s.size for t, s in _NUMBERS.items()}
+_ARRAY_ITEM = {TAG_BYTE_ARRAY: 1, TAG_INT_ARRAY: 4, TAG_LONG_ARRAY: 8}
+
+class Compound(dict):
+    """TAG_Compound - обычный dict"""
+
+class List(list):
+    """TAG_List - обычный list"""
+
+def _string(buf, pos):
+    n = _U16.unpack_from(buf, pos)[0]
+    pos += 2
+    # Как в nbtlib: битые байты не роняют разбор
+    return str(buf[pos:pos + n], "utf-8", "replace"), pos + n
+
+def _payload(buf, pos, tag):
+    """Читает значение тега целиком. Возвращает (значение, позиция после него)"""
+    num = _NUMBERS.get(tag)
+    if num is not None:
+        return num.unpack_from(buf, pos)[0], pos + num.size
+    if tag == TAG_STRING:
+        return _string(buf, pos)
+    if tag == TAG_COMPOUND:
+        value = Compound()
+        while True:
+            t = buf[pos]
+            pos += 1
+            if t == TAG_END:
+                return value, pos
+            name, pos = _string(buf, pos)
+            value[name], pos = _payload(buf, pos, t)
+    if tag == TAG_LIST:
+        t = buf[pos]
+        n = _I32.unpack_from(buf, pos + 1)[0]
+        pos += 5
+        value = List()
+        for _ in range(n):
+            item, pos = _payload(buf, pos, t)
+            value.append(item)
+        return value, pos
+    if tag == TAG_BYTE_ARRAY:
+        n = _I32.unpack_from(buf, pos)[0]
+        pos += 4
+        return bytes(buf[pos:pos + n]), pos + n
+    if tag == TAG_INT_ARRAY or tag == TAG_LONG_ARRAY:
+        n = _I32.unpack_from(buf, pos)[0]
+        pos += 4
+        fmt = ">%d%s" % (n, "i" if tag == TAG_INT_ARRAY else "q")
+        return list(struct.unpack_from(fmt, buf, pos)), pos + n * _ARRAY_ITEM[tag]
+    raise ValueError(f"Неизвестный тип тега {tag} на позиции {pos}")
+
+def _skip(buf, pos, tag):
+    """Пропускает значение тега, ничего не создавая. Возвращает позицию после него"""
+    size = _SIZES.get(tag)
+    if size is not None:
+        return pos + size
+    if tag == TAG_STRING:
+        return pos + 2 + _U16.unpack_from(buf, pos)[0]
+    if tag == TAG_COMPOUND:
+        while True:
+            t = buf[pos]
+            pos += 1
+            if t == TAG_END:
+                return pos
+            pos += 2 + _U16.unpack_from(buf, pos)[0]
+            pos = _skip(buf, pos, t)
+    if tag == TAG_LIST:
+        t = buf[pos]
+        n = _I32.unpack_from(buf, pos + 1)[0]
+        pos += 5
+        size = _SIZES.get(t)
+        if size is not None:
+            return pos + n * size
+        for _ in range(n):
+            pos = _skip(buf, pos, t)
+        return pos
+    if tag in _ARRAY_ITEM:
+        return pos + 4 + _I32.unpack_from(buf, pos)[0] * _ARRAY_ITEM[tag]
+    raise ValueError(f"Неизвестный тип тега {tag} на позиции {pos}")
+
+def _select(buf, pos, select):
+    """Читает compound, но строит только ключи из select (None - ветка целиком)"""
+    value = Compound()
+    while True:
+        t = buf[pos]
+        pos += 1
+        if t == TAG_END:
+            return value, pos
+        n = _U16.unpack_from(buf, pos)[0]
+        key = bytes(buf[pos + 2:pos + 2 + n])
+        pos += 2 + n
+        if key not in select:
+            pos = _skip(buf, pos, t)
+            continue
+        sub = select[key]
+        name = key.decode("utf-8", "replace")
+        if sub is None or t != TAG_COMPOUND:
+            value[name], pos = _payload(buf, pos, t)
+        else:
+            value[name], pos = _select(buf, pos, sub)
+
+def _encode_select(select):
+    return {k.encode("utf-8"): (None if v is None else _encode_select(v)) for k, v in select.items()}
+
+def read_nbt(data, select=None):
+    """Разбирает несжатый NBT и возвращает корневой Compound.
+
+    select - дерево нужных ключей, например {"Level": {"TileEntities": None}}:
+    None значит "ветку целиком", всё, чего в select нет, пропускается без разбора.
+    Без select читается всё дерево.
+    """
+    buf = data if isinstance(data, (bytes, bytearray)) else memoryview(data)
+    if not buf or buf[0] != TAG_COMPOUND:
+        raise ValueError("NBT должен начинаться с TAG_Compound")
+    pos = 3 + _U16.unpack_from(buf, 1)[0]  # имя корня не нужно
+    if select is None:
+        return _payload(buf, pos, TAG_COMPOUND)[0]
+    return _select(buf, pos, _encode_select(select))[0]
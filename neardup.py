@@ -0,0 +1,150 @@
+# Поиск почти одинаковых книг для decode.py: переподписанные копии, книга с одной
+# исправленной страницей, разные варианты починки кодировки.
+# Попарно 100k книг не сравнить, поэтому MinHash + LSH: у каждой книги короткая подпись
+# по шинглам страниц, кандидаты в дубли - книги, у которых совпала хоть одна полоса
+# подписи. Время почти линейное по числу книг. Сторонних либ не нужно.
+
+import hashlib, re
+from array import array
+from collections import deque
+
+# Длина подписи и сколько слов в шингле
+NUM_PERM = 64
+SHINGLE_WORDS = 3
+# Сколько книг из одной корзины LSH сверять с новой - чтобы огромная корзина
+# (например, сотни книг с одинаковой первой страницей) не сделала всё квадратичным
+MAX_CANDIDATES = 32
+
+_FORMAT_CODES = re.compile("§.")
+_WORDS = re.compile(r"\w+")
+# Значение в слоте - 52 бита хеша, выше - на сколько слотов позаимствовано (см. signature)
+_VALUE_BITS = 52
+_EMPTY = (1 << 64) - 1
+
+def shingles(pages, k=SHINGLE_WORDS):
+    """Множество шинглов - по k подряд идущих слов, без регистра, ё = е и без §-кодов цвета"""
+    text = _FORMAT_CODES.sub(" ", " ".join(pages)).lower().replace("ё", "е")
+    words = _WORDS.findall(text)
+    if len(words) <= k:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + k]) for i in range(len(words) - k + 1)}
+
+def _add_shingle(sig, shingle):
+    num_perm = len(sig)
+    h = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little")
+    slot = h % num_perm
+    value = (h // num_perm) & ((1 << _VALUE_BITS) - 1)
+    if value < sig[slot]:
+        sig[slot] = value
+
+def _densify(sig):
+    num_perm = len(sig)
+    if all(v == _EMPTY for v in sig):
+        return None
+    dense = sig[:]
+    for i in range(num_perm):
+        if sig[i] == _EMPTY:
+            dist = next(d for d in range(1, num_perm) if sig[(i + d) % num_perm] != _EMPTY)
+            dense[i] = sig[(i + dist) % num_perm] | (dist << _VALUE_BITS)
+    return array("Q", dense)
+
+def signature(pages, num_perm=NUM_PERM):
+    """MinHash-подпись страниц или None, если текста нет.
+    Одна хеш-функция вместо num_perm: слот - остаток хеша, в слоте минимум (one permutation
+    hashing). Пустые слоты занимают значение у ближайшего непустого справа"""
+    sig = [_EMPTY] * num_perm
+    for shingle in shingles(pages):
+        _add_shingle(sig, shingle)
+    return _densify(sig)
+
+class MinHasher:
+    """Та же подпись, что signature(), но страницы подаются по одной и в памяти не копятся -
+    для огромных книг. Шинглы через границу страниц учитываются так же"""
+
+    def __init__(self, num_perm=NUM_PERM, k=SHINGLE_WORDS):
+        self.k = k
+        self.sig = [_EMPTY] * num_perm
+        self.words = 0
+        self._last = deque(maxlen=k)
+
+    def update(self, page):
+        text = _FORMAT_CODES.sub(" ", page).lower().replace("ё", "е")
+        for word in _WORDS.findall(text):
+            self._last.append(word)
+            self.words += 1
+            if self.words >= self.k:
+                _add_shingle(self.sig, " ".join(self._last))
+
+    def signature(self):
+        if 0 < self.words < self.k:
+            _add_shingle(self.sig, " ".join(self._last))
+        return _densify(self.sig)
+
+def similarity(a, b) -> float:
+    """Оценка коэффициента Жаккара по двум подписям"""
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+def lsh_params(threshold: float, num_perm=NUM_PERM):
+    """(полос, строк в полосе) для порога: полосы ловят пары с похожестью от ~(1/b)^(1/r).
+    Берём самый высокий такой порог, не выше заданного - лишних кандидатов отсеет сверка"""
+    options = [(num_perm // r, r) for r in range(1, num_perm + 1) if num_perm % r == 0]
+    below = [(b, r) for b, r in options if (1 / b) ** (1 / r) <= threshold]
+    if not below:
+        return options[0]
+    return max(below, key=lambda br: (1 / br[0]) ** (1 / br[1]))
+
+class NearDupIndex:
+    """LSH-индекс подписей. add() сразу склеивает книгу с найденными похожими (union-find),
+    clusters() отдаёт группы из двух и больше книг"""
+
+    def __init__(self, threshold=0.8, num_perm=NUM_PERM, max_candidates=MAX_CANDIDATES):
+        self.threshold = threshold
+        self.bands, self.rows = lsh_params(threshold, num_perm)
+        self.max_candidates = max_candidates
+        self.tables = [{} for _ in range(self.bands)]
+        self.names = []
+        self.sizes = []
+        self.sigs = []
+        self._parent = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def _find(self, i):
+        parent = self._parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def add(self, name, sig, size=0):
+        """Добавляет книгу. size - объём текста, самая полная книга кластера станет главной"""
+        i = len(self.names)
+        self.names.append(name)
+        self.sizes.append(size)
+        self.sigs.append(sig)
+        self._parent.append(i)
+        rows = self.rows
+        for band, table in enumerate(self.tables):
+            bucket = table.setdefault(sig[band * rows:(band + 1) * rows].tobytes(), [])
+            for j in bucket[:self.max_candidates]:
+                root_i, root_j = self._find(i), self._find(j)
+                if root_i != root_j and similarity(sig, self.sigs[j]) >= self.threshold:
+                    self._parent[max(root_i, root_j)] = min(root_i, root_j)
+            bucket.append(i)
+
+    def clusters(self):
+        """[(главная книга, [(книга, похожесть на главную), ...])] - главная: самая полная,
+        при равенстве - встреченная раньше"""
+        groups = {}
+        for i in range(len(self.names)):
+            groups.setdefault(self._find(i), []).append(i)
+        result = []
+        for members in groups.values():
+            if len(members) < 2:
+                continue
+            main = max(members, key=lambda i: (self.sizes[i], -i))
+            others = [(self.names[i], round(similarity(self.sigs[main], self.sigs[i]), 3))
+                      for i in members if i != main]
+            result.append((self.names[main], others))
+        return result
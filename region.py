@@ -0,0 +1,144 @@
+# Чтение региона .mca без seek/read на каждый чанк.
+# Файл мапится в память целиком (или читается одним read, если mmap не вышел),
+# чанки отдаются в том порядке, в каком лежат на диске, срезами memoryview без копий.
+# Для конвейера с потоками есть fetch(): обычное чтение с диска, на время которого
+# GIL отпускается (обращение к mmap держит GIL, пока ОС подгружает страницу).
+
+import gzip, mmap, os, struct, zlib
+from pathlib import Path
+
+SECTOR = 4096
+
+# Байт компрессии в заголовке чанка
+GZIP, ZLIB, NONE = 1, 2, 3
+# Флаг "данные чанка в отдельном файле c.X.Z.mcc" (чанки больше 1 МиБ, новые версии)
+EXTERNAL = 0x80
+
+def decompress(compression: int, data) -> bytes:
+    """Распаковывает данные чанка, data - bytes или memoryview"""
+    if compression == ZLIB:
+        return zlib.decompress(data)
+    if compression == GZIP:
+        return gzip.decompress(data)
+    if compression == NONE:
+        return bytes(data)
+    raise ValueError(f"Неизвестная компрессия {compression}")
+
+def prefetch(path):
+    """Просит ОС заранее прочитать файл в кеш, пока мы заняты другим. Где нельзя - ничего"""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+class RegionFile:
+    """Один файл региона. Использовать через with, чтобы mmap закрылся вовремя"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        # Координаты региона из имени r.X.Z.mca, нужны для координат чанков и .mcc
+        try:
+            _, x, z = self.path.stem.split(".")
+            self.x, self.z = int(x), int(z)
+        except ValueError:
+            self.x = self.z = 0
+        self._map = None
+        self._file = None
+        with open(self.path, "rb") as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.data = memoryview(self._map)
+            except (OSError, ValueError):
+                # Пустой файл или mmap не поддерживается - читаем разом
+                self.data = memoryview(f.read())
+        header = bytes(self.data[:2 * SECTOR])
+        self.locations = header[:SECTOR]
+        # Вторые 4 КиБ - время последнего сохранения каждого чанка (если заголовок целый)
+        self.timestamps = header[SECTOR:] if len(header) == 2 * SECTOR else b""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.data.release()
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # Кто-то ещё держит срез - mmap закроется сборщиком мусора
+                pass
+            self._map = None
+
+    def chunk_coords(self, idx: int):
+        """Абсолютные координаты чанка по номеру слота"""
+        return (idx % 32) + self.x * 32, (idx // 32) + self.z * 32
+
+    def timestamp(self, idx: int) -> int:
+        if not self.timestamps:
+            return 0
+        return struct.unpack_from(">I", self.timestamps, idx * 4)[0]
+
+    def entries(self):
+        """Занятые слоты [(номер, сектор, число секторов)] в порядке расположения на диске"""
+        found = []
+        locs = self.locations
+        for idx in range(min(1024, len(locs) // 4)):
+            off = idx * 4
+            sector_offset = (locs[off] << 16) | (locs[off + 1] << 8) | locs[off + 2]
+            sector_count = locs[off + 3]
+            if sector_offset == 0 or sector_count == 0:
+                continue
+            found.append((idx, sector_offset, sector_count))
+        found.sort(key=lambda e: e[1])
+        return found
+
+    def read(self, idx: int, sector_offset: int):
+        """Сжатые данные чанка: (компрессия, memoryview или bytes) или None, если слот битый"""
+        start = sector_offset * SECTOR
+        if start + 5 > len(self.data):
+            return None
+        length, compression = struct.unpack_from(">IB", self.data, start)
+        if length < 1:
+            return None
+        if compression & EXTERNAL:
+            cx, cz = self.chunk_coords(idx)
+            external = self.path.with_name(f"c.{cx}.{cz}.mcc")
+            return compression & ~EXTERNAL, external.read_bytes()
+        return compression, self.data[start + 5:start + 4 + length]
+
+    def fetch(self, idx: int, sector_offset: int, sector_count: int):
+        """Как read(), но читает сектора чанка с диска одним вызовом в отдельный bytes.
+        Для потока-читателя: GIL на время чтения отпускается, от mmap результат не зависит"""
+        if self._file is None:
+            self._file = open(self.path, "rb", buffering=0)
+        self._file.seek(sector_offset * SECTOR)
+        data = self._file.read(sector_count * SECTOR)
+        if len(data) < 5:
+            return None
+        length, compression = struct.unpack_from(">IB", data)
+        if length < 1:
+            return None
+        if compression & EXTERNAL:
+            cx, cz = self.chunk_coords(idx)
+            external = self.path.with_name(f"c.{cx}.{cz}.mcc")
+            return compression & ~EXTERNAL, external.read_bytes()
+        return compression, data[5:4 + length]
+
+    def chunks(self):
+        """(номер, компрессия, сжатые данные) для всех чанков, в порядке на диске"""
+        for idx, sector_offset, _ in self.entries():
+            found = self.read(idx, sector_offset)
+            if found is not None:
+                yield (idx,) + found
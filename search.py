@@ -0,0 +1,316 @@
+# Полнотекстовый поиск по выгруженным книгам, чтобы не грепать тысячи JSON.
+# Индекс - обратный, в SQLite (exported_books/search.index): слово -> книги и позиции в них.
+# Строится из того, что пишут book.py и decode.py (папка, .jsonl, .sqlite - см. sinks.py),
+# повторный запуск переиндексирует только новые и изменившиеся книги.
+#   python search.py index                           - books_json и books_fixed
+#   python search.py index -i exported_books/books.jsonl
+#   python search.py query замок дракон              - все слова
+#   python search.py query '"старый замок"'          - фраза
+#   python search.py query author:Игрок12 драк*      - автор, начало слова
+# Поля для запроса: title:, author:, location:, pages: (без поля - везде)
+
+import argparse, hashlib, json, math, re, sqlite3, time
+from array import array
+from pathlib import Path
+from sinks import open_sink
+
+OUTPUT_DIR = Path(__file__).with_name("exported_books")
+INDEX_FILE = OUTPUT_DIR / "search.index"
+
+# Поля книги и их вес при ранжировании: совпадение в названии важнее, чем в тексте
+FIELDS = {"title": 0, "author": 1, "pages": 2, "location": 3}
+WEIGHTS = {0: 3.0, 1: 2.0, 2: 1.0, 3: 0.5}
+# Позиция слова в тексте: номер страницы << PAGE_SHIFT | номер слова на странице.
+# Фраза не склеивается через границу страниц. Так же location: основная находка - 0,
+# остальные (copies после дедупликации) - 1, 2...
+PAGE_SHIFT = 20
+# Меняется, когда меняется то, что попадает в индекс - тогда книги переиндексируются
+INDEX_VERSION = 2
+
+_FORMAT_CODES = re.compile("§.")
+_TOKEN = re.compile(r"\w+")
+# Элемент запроса: необязательное поле:, дальше фраза в кавычках или слово
+_QUERY = re.compile(r'(?:(\w+):)?(?:"([^"]*)"|(\S+))')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    id INTEGER PRIMARY KEY, source TEXT NOT NULL, key TEXT NOT NULL, hash TEXT NOT NULL,
+    title TEXT, author TEXT, location TEXT, UNIQUE (source, key));
+CREATE TABLE IF NOT EXISTS terms (id INTEGER PRIMARY KEY, term TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS postings (
+    term_id INTEGER NOT NULL, doc_id INTEGER NOT NULL, field INTEGER NOT NULL, positions BLOB NOT NULL,
+    PRIMARY KEY (term_id, doc_id, field)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc_id);
+"""
+
+def normalize(text: str) -> str:
+    """Без регистра, ё = е, без §-кодов цвета. Код заменяется двумя пробелами - позиции
+    в тексте те же, что в исходной странице (для snippet)"""
+    return _FORMAT_CODES.sub("  ", text).lower().replace("ё", "е")
+
+def tokenize(text: str) -> list:
+    return _TOKEN.findall(normalize(text))
+
+def open_index(path, readonly=False):
+    if readonly:
+        return sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA synchronous = NORMAL")
+    db.executescript(SCHEMA)
+    return db
+
+def doc_hash(book: dict) -> str:
+    data = json.dumps(book, ensure_ascii=False, sort_keys=True)
+    return hashlib.md5(f"{INDEX_VERSION}:{data}".encode("utf-8")).hexdigest()
+
+def book_positions(book: dict) -> dict:
+    """(слово, поле) -> позиции"""
+    found = {}
+    for name in ("title", "author"):
+        for i, token in enumerate(tokenize(str(book.get(name, "")))):
+            found.setdefault((token, FIELDS[name]), []).append(i)
+    # Где лежат копии - тоже location: книгу после дедупликации находит любое её место
+    locations = [book.get("location", "")] + [copy.get("location", "") for copy in book.get("copies", [])]
+    for loc_no, location in enumerate(locations):
+        base = loc_no << PAGE_SHIFT
+        for i, token in enumerate(tokenize(str(location))):
+            found.setdefault((token, FIELDS["location"]), []).append(base | i)
+    for page_no, page in enumerate(book.get("pages", [])):
+        base = page_no << PAGE_SHIFT
+        for i, token in enumerate(tokenize(str(page))):
+            found.setdefault((token, FIELDS["pages"]), []).append(base | i)
+    return found
+
+class Indexer:
+    """Добавляет и удаляет книги в индексе. id слов кешируются в памяти на время индексации"""
+
+    def __init__(self, db, batch=500):
+        self.db = db
+        self.batch = batch
+        self._pending = 0
+        self.term_ids = dict(db.execute("SELECT term, id FROM terms"))
+
+    def term_id(self, term):
+        tid = self.term_ids.get(term)
+        if tid is None:
+            tid = self.term_ids[term] = self.db.execute("INSERT INTO terms (term) VALUES (?)", (term,)).lastrowid
+        return tid
+
+    def add(self, source, key, digest, book):
+        doc_id = self.db.execute(
+            "INSERT INTO docs (source, key, hash, title, author, location) VALUES (?, ?, ?, ?, ?, ?)",
+            (source, key, digest, book.get("title"), book.get("author"), book.get("location"))).lastrowid
+        rows = [(self.term_id(term), doc_id, field, array("Q", positions).tobytes())
+                for (term, field), positions in book_positions(book).items()]
+        self.db.executemany("INSERT INTO postings (term_id, doc_id, field, positions) VALUES (?, ?, ?, ?)", rows)
+        self._changed()
+
+    def delete(self, doc_id):
+        self.db.execute("DELETE FROM postings WHERE doc_id = ?", (doc_id,))
+        self.db.execute("DELETE FROM docs WHERE id = ?", (doc_id,))
+        self._changed()
+
+    def _changed(self):
+        self._pending += 1
+        if self._pending >= self.batch:
+            self.db.commit()
+            self._pending = 0
+
+    def index_source(self, path):
+        """Приводит индекс в соответствие с хранилищем книг path. Возвращает счётчики"""
+        source = Path(path).resolve().as_posix()
+        existing = {key: (doc_id, digest) for doc_id, key, digest in
+                    self.db.execute("SELECT id, key, hash FROM docs WHERE source = ?", (source,))}
+        stats = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0}
+        seen = set()
+        books = open_sink(path, "r")
+        try:
+            for key, book in books.items():
+                seen.add(key)
+                digest = doc_hash(book)
+                old = existing.get(key)
+                if old and old[1] == digest:
+                    stats["unchanged"] += 1
+                    continue
+                if old:
+                    self.delete(old[0])
+                    stats["updated"] += 1
+                else:
+                    stats["added"] += 1
+                self.add(source, key, digest, book)
+        finally:
+            books.close()
+        for key in existing.keys() - seen:
+            self.delete(existing[key][0])
+            stats["removed"] += 1
+        self.db.commit()
+        return stats
+
+def parse_query(query: str):
+    """Запрос -> [(поле или None, слова, фраза?, префикс?)]"""
+    clauses = []
+    for field, phrase, word in _QUERY.findall(query):
+        if field and field not in FIELDS:
+            # "http://..." или "слово:" - это не поле
+            word = f"{field}:{phrase or word}"
+            field, phrase = "", ""
+        text = phrase or word
+        prefix = bool(word) and word.endswith("*")
+        tokens = tokenize(text)
+        if not tokens:
+            continue
+        clauses.append((FIELDS.get(field), tokens, bool(phrase), prefix and len(tokens) == 1))
+    return clauses
+
+def term_postings(db, token, field, prefix=False):
+    """doc_id -> {поле: множество позиций} для слова (или всех слов с таким началом)"""
+    if prefix:
+        term_ids = [tid for tid, in db.execute("SELECT id FROM terms WHERE term >= ? AND term < ?",
+                                               (token, token + "\uffff"))]
+    else:
+        term_ids = [tid for tid, in db.execute("SELECT id FROM terms WHERE term = ?", (token,))]
+    found = {}
+    for tid in term_ids:
+        sql = "SELECT doc_id, field, positions FROM postings WHERE term_id = ?"
+        args = (tid,)
+        if field is not None:
+            sql += " AND field = ?"
+            args += (field,)
+        for doc_id, f, blob in db.execute(sql, args):
+            positions = array("Q")
+            positions.frombytes(blob)
+            found.setdefault(doc_id, {}).setdefault(f, set()).update(positions)
+    return found
+
+def clause_matches(db, field, tokens, phrase, prefix):
+    """doc_id -> {поле: сколько раз совпало} для одного элемента запроса"""
+    if len(tokens) == 1:
+        return {doc: {f: len(p) for f, p in fields.items()}
+                for doc, fields in term_postings(db, tokens[0], field, prefix).items()}
+    per_token = [term_postings(db, t, field) for t in tokens]
+    docs = set(min(per_token, key=len)).intersection(*per_token)
+    # Без кавычек слова могут быть где угодно в поле, в кавычках - подряд
+    matches = {}
+    for doc in docs:
+        counts = {}
+        for f in set.intersection(*(set(p[doc]) for p in per_token)):
+            if phrase:
+                first, rest = per_token[0][doc][f], [p[doc][f] for p in per_token[1:]]
+                n = sum(all(pos + i in positions for i, positions in enumerate(rest, 1)) for pos in first)
+            else:
+                n = min(len(p[doc][f]) for p in per_token)
+            if n:
+                counts[f] = n
+        if counts:
+            matches[doc] = counts
+    return matches
+
+def search(db, query: str, limit=20):
+    """[(очки, doc_id)] лучших книг, в которых есть все элементы запроса"""
+    clauses = parse_query(query)
+    if not clauses:
+        return []
+    total = db.execute("SELECT COUNT(*) FROM docs").fetchone()[0] or 1
+    scores = None
+    for clause in clauses:
+        matches = clause_matches(db, *clause)
+        idf = math.log(1 + total / (len(matches) or 1))
+        clause_scores = {doc: idf * sum(WEIGHTS[f] * (1 + math.log(n)) for f, n in counts.items())
+                         for doc, counts in matches.items()}
+        if scores is None:
+            scores = clause_scores
+        else:
+            scores = {doc: s + clause_scores[doc] for doc, s in scores.items() if doc in clause_scores}
+        if not scores:
+            return []
+    return sorted(((s, doc) for doc, s in scores.items()), key=lambda x: (-x[0], x[1]))[:limit]
+
+def snippet(book: dict, clauses, width=80) -> str:
+    """Кусок страницы вокруг первого найденного слова запроса"""
+    # Сначала фразы целиком, потом отдельные слова
+    words = [" ".join(tokens) for _, tokens, phrase, _ in clauses if phrase]
+    words += [t for _, tokens, _, _ in clauses for t in tokens]
+    pages = [(str(page), normalize(str(page))) for page in book.get("pages", [])]
+    for word in words:
+        for page_no, (page, text) in enumerate(pages, 1):
+            pos = text.find(word)
+            if pos >= 0:
+                start = max(0, pos - width // 2)
+                piece = " ".join(page[start:start + width].split())
+                return f"стр. {page_no}: {'...' if start else ''}{piece}..."
+    return ""
+
+def cmd_index(args):
+    sources = args.input or [p for p in (OUTPUT_DIR / "books_json", OUTPUT_DIR / "books_fixed") if p.exists()]
+    if not sources:
+        print("Нечего индексировать: нет ни books_json, ни books_fixed, укажите -i")
+        return
+    db = open_index(args.index)
+    indexer = Indexer(db)
+    for source in sources:
+        start = time.perf_counter()
+        stats = indexer.index_source(source)
+        print(f"{source}: новых {stats['added']}, изменённых {stats['updated']}, "
+              f"удалённых {stats['removed']}, без изменений {stats['unchanged']} "
+              f"({time.perf_counter() - start:.1f} с)")
+    if args.prune:
+        # Книги из хранилищ, которые в этот раз не индексировались
+        wanted = {Path(s).resolve().as_posix() for s in sources}
+        for doc_id, source in db.execute("SELECT id, source FROM docs").fetchall():
+            if source not in wanted:
+                indexer.delete(doc_id)
+    db.commit()
+    db.close()
+    print("Индекс:", args.index)
+
+def cmd_query(args):
+    if not args.index.exists():
+        print(f"Индекс {args.index} не найден, сначала: python search.py index")
+        return
+    db = open_index(args.index, readonly=True)
+    query = " ".join(args.query)
+    start = time.perf_counter()
+    results = search(db, query, args.limit)
+    elapsed = time.perf_counter() - start
+    clauses = parse_query(query)
+    sinks = {}
+    for score, doc_id in results:
+        source, key, title, author, location = db.execute(
+            "SELECT source, key, title, author, location FROM docs WHERE id = ?", (doc_id,)).fetchone()
+        print(f"{score:7.2f}  {title} ({author})  –  {location}")
+        print(f"         {key}  [{source}]")
+        if args.snippets:
+            # Читаем только найденные книги, и то если хранилище ещё на месте
+            try:
+                if source not in sinks:
+                    sinks[source] = open_sink(source, "r")
+                text = snippet(sinks[source].get(key), clauses)
+            except Exception:
+                text = ""
+            if text:
+                print(f"         {text}")
+    print(f"Найдено: {len(results)} ({elapsed * 1000:.0f} мс)")
+    db.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Поиск по выгруженным книгам")
+    parser.add_argument("--index", type=Path, default=INDEX_FILE, help="файл индекса")
+    sub = parser.add_subparsers(dest="what", required=True)
+    idx = sub.add_parser("index", help="построить или обновить индекс")
+    idx.add_argument("-i", "--input", type=Path, action="append",
+                     help="хранилище книг (можно несколько раз), по умолчанию books_json и books_fixed")
+    idx.add_argument("--prune", action="store_true", help="убрать из индекса книги из других хранилищ")
+    q = sub.add_parser("query", help="найти книги")
+    q.add_argument("query", nargs="+")
+    q.add_argument("-n", "--limit", type=int, default=20)
+    q.add_argument("--no-snippets", dest="snippets", action="store_false",
+                   help="не показывать кусок страницы (он читается из хранилища книг)")
+    args = parser.parse_args()
+    if args.what == "index":
+        cmd_index(args)
+    else:
+        cmd_query(args)
+
+if __name__ == "__main__":
+    main()
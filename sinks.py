@@ -0,0 +1,378 @@
+# Куда складывать книги. Общий модуль для book.py и decode.py.
+# Вид хранилища выбирается по пути:
+#   exported_books/books_json    - папка, по JSON-файлу на книгу (как раньше)
+#   exported_books/books.jsonl   - один файл, по строке на книгу, пишется буфером
+#   exported_books/books.sqlite  - SQLite, коммит пачками
+#   exported_books/books.pages   - SQLite, где каждая разная страница хранится один раз (PageSink)
+# Книга хранится под строковым ключом (для папки это имя файла без .json).
+# mode: "r" - только читать, "a" - дописывать к тому что есть, "w" - начать заново.
+# Огромные книги (модовые, десятки тысяч страниц) можно не держать в памяти целиком:
+# items(stream_over=N) у папки отдаёт вместо книги больше N байт путь к её файлу,
+# а put_file() кладёт книгу, уже записанную JSON-ом в файл.
+# Для --resume: checkpoint() делает записанное надёжным и отдаёт состояние (JSON),
+# restore(состояние, ключи) возвращает хранилище к нему - книги, записанные после, убираются.
+
+import hashlib, json, logging, os, shutil, sqlite3
+from pathlib import Path
+
+log = logging.getLogger("sinks")
+
+class DirSink:
+    """По JSON-файлу на книгу"""
+
+    def __init__(self, path, mode="a", indent=1):
+        self.path = Path(path)
+        self.indent = indent
+        self.errors = 0
+        if mode != "r":
+            self.path.mkdir(parents=True, exist_ok=True)
+        if mode == "w":
+            # Заново - значит без книг прошлой выгрузки, как у остальных хранилищ. Удаляются только
+            # книги (book_*.json): -o может указывать и на папку, где лежит что-то ещё
+            for fname in self.path.glob("book_*.json"):
+                fname.unlink()
+
+    def _file(self, key):
+        return self.path / f"{key}.json"
+
+    def put(self, key, book):
+        with open(self._file(key), "w", encoding="utf-8") as f:
+            json.dump(book, f, ensure_ascii=False, indent=self.indent)
+
+    def put_file(self, key, path, title=None, author=None):
+        """Кладёт книгу из JSON-файла path (файл забирается, лучше, чтобы он был в этой же папке)"""
+        os.replace(path, self._file(key))
+
+    def delete(self, key):
+        self._file(key).unlink(missing_ok=True)
+
+    def get(self, key):
+        with open(self._file(key), encoding="utf-8") as f:
+            return json.load(f)
+
+    def __contains__(self, key):
+        return self._file(key).exists()
+
+    def keys(self):
+        return [fname.stem for fname in self.path.glob("*.json")]
+
+    def checkpoint(self):
+        return {}
+
+    def restore(self, state, keys):
+        for key in self.keys():
+            if key not in keys and key.startswith("book_"):
+                self.delete(key)
+
+    def items(self, stream_over=None):
+        for fname in sorted(self.path.glob("*.json")):
+            if stream_over is not None and fname.stat().st_size > stream_over:
+                yield fname.stem, fname
+                continue
+            try:
+                with open(fname, encoding="utf-8") as f:
+                    book = json.load(f)
+            except Exception as e:
+                self.errors += 1
+                log.warning(f"Не удалось прочитать {fname.name}: {e}")
+                continue
+            yield fname.stem, book
+
+    def close(self):
+        pass
+
+class JsonlSink:
+    """Одна строка {"key": ..., "book": {...}} на книгу. Удаление - строка с "book": null,
+    при чтении побеждает последняя запись ключа. Пишет буфером, а не по книге"""
+
+    def __init__(self, path, mode="a", buffer_size=1 << 20):
+        self.path = Path(path)
+        self.buffer_size = buffer_size
+        self.errors = 0
+        self._buf = []
+        self._buffered = 0
+        self._out = None
+        # ключ -> смещение последней живой записи в файле
+        self._index = {}
+        if mode == "r" or (mode == "a" and self.path.exists()):
+            self._load_index()
+        if mode != "r":
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._out = open(self.path, "ab" if mode == "a" else "wb")
+            self._size = self._out.seek(0, 2)
+
+    def _load_index(self):
+        decoder = json.JSONDecoder()
+        offset = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    # Ключ всегда первым - остальную строку не разбираем
+                    text = line.decode("utf-8")
+                    key, end = decoder.raw_decode(text, len('{"key": '))
+                    if text.startswith(', "book": null}', end):
+                        self._index.pop(key, None)
+                    else:
+                        self._index[key] = offset
+                except Exception as e:
+                    self.errors += 1
+                    log.warning(f"Битая строка в {self.path.name} на смещении {offset}: {e}")
+                offset += len(line)
+
+    def _write(self, key, book):
+        line = json.dumps({"key": key, "book": book}, ensure_ascii=False).encode("utf-8") + b"\n"
+        self._buf.append(line)
+        self._buffered += len(line)
+        offset = self._size
+        self._size += len(line)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+        return offset
+
+    def flush(self):
+        if self._buf:
+            self._out.write(b"".join(self._buf))
+            self._out.flush()
+            self._buf.clear()
+            self._buffered = 0
+
+    def put(self, key, book):
+        self._index[key] = self._write(key, book)
+
+    def put_file(self, key, path, title=None, author=None):
+        """Кладёт книгу из однострочного JSON-файла path кусками, не читая целиком. Файл удаляется"""
+        self.flush()
+        head = ('{"key": %s, "book": ' % json.dumps(key, ensure_ascii=False)).encode("utf-8")
+        self._index[key] = self._size
+        self._out.write(head)
+        with open(path, "rb") as f:
+            shutil.copyfileobj(f, self._out, 1 << 20)
+        self._out.write(b"}\n")
+        self._out.flush()
+        self._size = self._out.tell()
+        os.remove(path)
+
+    def delete(self, key):
+        if self._index.pop(key, None) is not None:
+            self._write(key, None)
+
+    def checkpoint(self):
+        self.flush()
+        os.fsync(self._out.fileno())
+        return {"size": self._size}
+
+    def restore(self, state, keys):
+        """Обрезает файл до размера на момент чекпойнта"""
+        self.flush()
+        self._out.truncate(state["size"])
+        self._size = self._out.seek(0, 2)
+        self._index.clear()
+        self._load_index()
+
+    def _read(self, f, offset):
+        f.seek(offset)
+        return json.loads(f.readline())["book"]
+
+    def get(self, key):
+        if self._out:
+            self.flush()
+        with open(self.path, "rb") as f:
+            return self._read(f, self._index[key])
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def keys(self):
+        return list(self._index)
+
+    def items(self, stream_over=None):
+        if self._out:
+            self.flush()
+        with open(self.path, "rb") as f:
+            for key, offset in list(self._index.items()):
+                yield key, self._read(f, offset)
+
+    def close(self):
+        if self._out:
+            self.flush()
+            self._out.close()
+            self._out = None
+
+class SqliteSink:
+    """Таблица books(key, title, author, data) - data это JSON книги.
+    Коммит раз в batch изменений, а не на каждую книгу"""
+
+    def __init__(self, path, mode="a", batch=1000):
+        self.path = Path(path)
+        self.batch = batch
+        self.errors = 0
+        self._pending = 0
+        if mode == "r":
+            self.db = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS books "
+                        "(key TEXT PRIMARY KEY, title TEXT, author TEXT, data TEXT NOT NULL)")
+        if mode == "w":
+            self.db.execute("DELETE FROM books")
+        self.db.commit()
+
+    def _changed(self):
+        self._pending += 1
+        if self._pending >= self.batch:
+            self.db.commit()
+            self._pending = 0
+
+    def put(self, key, book):
+        self.db.execute("INSERT OR REPLACE INTO books (key, title, author, data) VALUES (?, ?, ?, ?)",
+                        (key, book.get("title"), book.get("author"), json.dumps(book, ensure_ascii=False)))
+        self._changed()
+
+    def put_file(self, key, path, title=None, author=None):
+        """Кладёт книгу из JSON-файла path. SQLite хранит data одной строкой, так что
+        файл читается целиком - но без разбора и копии-словаря. Файл удаляется"""
+        with open(path, encoding="utf-8") as f:
+            data = f.read()
+        self.db.execute("INSERT OR REPLACE INTO books (key, title, author, data) VALUES (?, ?, ?, ?)",
+                        (key, title, author, data))
+        self._changed()
+        os.remove(path)
+
+    def delete(self, key):
+        self.db.execute("DELETE FROM books WHERE key = ?", (key,))
+        self._changed()
+
+    def checkpoint(self):
+        self.db.commit()
+        self._pending = 0
+        return {}
+
+    def restore(self, state, keys):
+        # Незакоммиченное после чекпойнта SQLite откатил сам, остаётся то, что успело закоммититься
+        for key in self.keys():
+            if key not in keys:
+                self.delete(key)
+        self.db.commit()
+
+    def get(self, key):
+        row = self.db.execute("SELECT data FROM books WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def __contains__(self, key):
+        return self.db.execute("SELECT 1 FROM books WHERE key = ?", (key,)).fetchone() is not None
+
+    def keys(self):
+        return [key for key, in self.db.execute("SELECT key FROM books")]
+
+    def items(self, stream_over=None):
+        if self._pending:
+            self.db.commit()
+            self._pending = 0
+        for key, data in self.db.execute("SELECT key, data FROM books ORDER BY rowid"):
+            yield key, json.loads(data)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+def page_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+class PageSink(SqliteSink):
+    """Хранилище с адресацией страниц по содержимому: каждая разная страница лежит один раз
+    в pages(hash, text), книга в books - запись с теми же полями, но в "pages" вместо текста
+    список хешей страниц. Копии, черновики и тома одной серии делят страницы.
+    get()/items() собирают книгу целиком, record()/records() отдают запись как есть -
+    одинаковые книги можно найти, сравнивая короткие списки хешей, не читая страниц"""
+
+    def __init__(self, path, mode="a", batch=1000):
+        super().__init__(path, mode, batch)
+        # Заменили или удалили книгу - её страницы могли остаться ничьими, чистим при закрытии
+        self._orphans = False
+        if mode == "r":
+            return
+        self.db.execute("CREATE TABLE IF NOT EXISTS pages (hash TEXT PRIMARY KEY, text TEXT NOT NULL)")
+        if mode == "w":
+            self.db.execute("DELETE FROM pages")
+        self.db.commit()
+
+    def put(self, key, book):
+        record = dict(book)
+        if "pages" in book:
+            record["pages"] = [page_hash(page) for page in book["pages"]]
+            self.db.executemany("INSERT OR IGNORE INTO pages (hash, text) VALUES (?, ?)",
+                                zip(record["pages"], book["pages"]))
+        if not self._orphans and key in self:
+            self._orphans = True
+        super().put(key, record)
+
+    def put_file(self, key, path, title=None, author=None):
+        """Кладёт книгу из JSON-файла path. Страницы всё равно надо разложить по хешам,
+        так что файл разбирается целиком. Файл удаляется"""
+        with open(path, encoding="utf-8") as f:
+            self.put(key, json.load(f))
+        os.remove(path)
+
+    def delete(self, key):
+        super().delete(key)
+        self._orphans = True
+
+    def pages(self, hashes):
+        """Тексты страниц по хешам, в том же порядке"""
+        texts = {}
+        unique = list(set(hashes))
+        # Не больше 500 параметров в запросе - старые SQLite больше 999 не принимают
+        for i in range(0, len(unique), 500):
+            part = unique[i:i + 500]
+            texts.update(self.db.execute(
+                f"SELECT hash, text FROM pages WHERE hash IN ({','.join('?' * len(part))})", part))
+        return [texts[h] for h in hashes]
+
+    def rebuild(self, record):
+        """Книга из записи: хеши страниц заменяются их текстом"""
+        book = dict(record)
+        if "pages" in record:
+            book["pages"] = self.pages(record["pages"])
+        return book
+
+    def record(self, key):
+        return super().get(key)
+
+    def records(self):
+        yield from super().items()
+
+    def get(self, key):
+        return self.rebuild(self.record(key))
+
+    def items(self, stream_over=None):
+        for key, record in self.records():
+            yield key, self.rebuild(record)
+
+    def prune(self) -> int:
+        """Удаляет страницы, на которые не ссылается ни одна книга. Возвращает, сколько удалено"""
+        used = set()
+        for data, in self.db.execute("SELECT data FROM books"):
+            used.update(json.loads(data).get("pages", ()))
+        unused = [(h,) for h, in self.db.execute("SELECT hash FROM pages") if h not in used]
+        self.db.executemany("DELETE FROM pages WHERE hash = ?", unused)
+        return len(unused)
+
+    def close(self):
+        if self._orphans:
+            self.prune()
+        super().close()
+
+SINKS = {".jsonl": JsonlSink, ".sqlite": SqliteSink, ".sqlite3": SqliteSink, ".db": SqliteSink,
+         ".pages": PageSink}
+
+def open_sink(path, mode="a", indent=1):
+    """Открывает хранилище книг, вид - по расширению пути (без расширения - папка)"""
+    path = Path(path)
+    cls = SINKS.get(path.suffix.lower())
+    if cls is None:
+        return DirSink(path, mode, indent)
+    return cls(path, mode)